@@ -1,12 +1,28 @@
+import argparse
 import collections
-import mlpy
+import itertools
+import multiprocessing
+import sys
+import time
+import warnings
 import numpy as np
 import scipy as sp
 import csv
 import string
-from sklearn import linear_model
 
 recipesPath = '../mealplan/recipeData.txt'
+modelPath = './cuisineModel'
+sys.path.append('../mealplan')
+import cuisineModel
+
+# Labels the recipes of the planner with their cuisine, in two steps:
+#   python classifyCuisine.py train    # data.csv -> the model at modelPath
+#   python classifyCuisine.py predict  # recipeData.txt -> recipeWithCuisines.txt
+# Training picks the regularization, solver and class weights of the
+# logistic regression by k-fold cross-validation over GRID (see
+# selectModel()), on all cores, and saves the best model refit on all the
+# data. Prediction only loads the saved model (see mealplan/cuisineModel.py)
+# and does not need sklearn.
 
 cuisineMap = {}
 cuisineMap['NorthernEuropean'] =250
@@ -25,57 +41,79 @@ oppMap = {}
 for k,v in cuisineMap.iteritems():
 	oppMap[v] = k
 
+# Number of recipe lines predicted at once by readIngredients(), and the
+# buffer size of its output file.
+CHUNK_SIZE = 4096
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Model selection grid: every solver is tried with every class weighting,
+# 'balanced' compensating for NorthAmerican dominating the labels, and
+# every C (inverse regularization strength). Both solvers work on the sparse
+# features directly. The Cs are fit in increasing order on each fold, and
+# saga warm-starts each fit from the previous one; liblinear cannot, but is
+# often faster on small data sets anyway.
+GRID = {
+	'solver': ['saga', 'liblinear'],
+	'classWeight': [None, 'balanced'],
+	'C': [0.01, 0.1, 1.0, 10.0, 100.0],
+}
+FOLDS = 5
+MAX_ITER = 1000
+
 def process(filename):
-	ingredientSet = getIngreds()
-	X = []
+	ingredientIndex = makeIngredientIndex(getIngreds())
 	Y = []
 	ingredientsList = []
-	countCuisine = 0
 	with open(filename, 'rb') as dataset:
 		datareader = csv.reader(dataset)
-		tempX = []
 		for row in datareader:
-			cuisine = row[0]
-			orig = row[1:]
-			ingredients = collections.Counter(orig)
-			ingredientsList.append(orig)
-			tempX.append((ingredients, cuisineMap.get(cuisine)))
-		for ingredients, cuisine in tempX:
-			featureVector = [0] * len(ingredientSet)
-			for index, ingredient in enumerate(ingredientSet):
-				if ingredient in ingredients:
-					featureVector[index] = 1
-				else:
-					featureVector[index] = 0
-			X.append(featureVector)
-			Y.append(cuisine)
-		return X, Y, ingredientSet, cuisineMap, ingredientsList
-
-def readIngredients(predictor, ingredientSet):
-	ingredientsList = collections.OrderedDict()
-	with open(recipesPath, 'rb') as dataset, open('./recipeWithCuisines.txt', 'wb') as output:
-		for line in dataset:
-			orig = line.strip()
-			ingredients = []
-			line = line.split("<>")
-			ingredString = line[6]
-			ingredList = ingredString.split(',')
-			for ingred in ingredList:
-				ingred = ingred.split(';')
-				ingredients.append(ingred[0])
-			testX = constructFeatureVector(ingredients, ingredientSet)
-			cuisine = predictor.predict([testX])
-			output.write(orig + "<>" + oppMap[cuisine[0]] + '\n')
-	return ingredientsList
-
-def constructFeatureVector(ingredients, ingredientSet):
-	featureVector = [0] * len(ingredientSet)
-	for index, ingredient in enumerate(ingredientSet):
-		if ingredient in ingredients:
-			featureVector[index] = 1
-		else:
-			featureVector[index] = 0
-	return featureVector
+			ingredientsList.append(row[1:])
+			Y.append(cuisineMap.get(row[0]))
+	X = featurize(ingredientsList, ingredientIndex)
+	return X, Y, ingredientIndex, cuisineMap, ingredientsList
+
+def readIngredients(model, chunkSize=CHUNK_SIZE):
+	"""
+	Writes each line of the recipe file followed by the cuisine the
+	CuisineModel |model| gives it to recipeWithCuisines.txt. The file is read
+	|chunkSize| lines at a time, and the ingredients of each chunk are parsed
+	from its lines, featurized into one sparse matrix, predicted in one call
+	and written at once, so memory stays bounded whatever the size of the
+	file.
+
+	@return numLines: The number of lines written.
+	"""
+	numLines = 0
+	with open(recipesPath, 'rb') as dataset, \
+			open('./recipeWithCuisines.txt', 'wb', OUTPUT_BUFFER_SIZE) as output:
+		while True:
+			lines = list(itertools.islice(dataset, chunkSize))
+			if not lines: break
+			testX = model.featurize(parseIngredients(line) for line in lines)
+			cuisines = model.predict_features(testX)
+			output.write(''.join(line.strip() + "<>" + cuisine + '\n' \
+				for line, cuisine in zip(lines, cuisines)))
+			numLines += len(lines)
+	return numLines
+
+def parseIngredients(line):
+	"""
+	Returns the ingredient names of a |line| of the recipe file.
+	"""
+	return [ingred.split(';')[0] for ingred in line.split("<>")[6].split(',')]
+
+def constructFeatureVector(ingredients, ingredientIndex):
+	return cuisineModel.featurize([ingredients], ingredientIndex)
+
+def makeIngredientIndex(ingredientSet):
+	"""
+	Returns the dict from each ingredient of |ingredientSet| to its column in
+	the feature matrices, in sorted order.
+	"""
+	return cuisineModel.make_ingredient_index(sorted(ingredientSet))
+
+def featurize(ingredientsList, ingredientIndex):
+	return cuisineModel.featurize(ingredientsList, ingredientIndex)
 
 def getIngreds(file1='ingredients_stats'):
 	ingredientSet = set()
@@ -85,11 +123,166 @@ def getIngreds(file1='ingredients_stats'):
 	return ingredientSet
 
 def predictCuisine(trainX, trainY):
+	# only needed for training
+	from sklearn import linear_model
 	logreg = linear_model.LogisticRegression()
 	logreg.fit(trainX, trainY)
 	return logreg
 
+def makeClassifier(solver, classWeight, C):
+	"""
+	Returns an unfitted one-vs-rest LogisticRegression of the grid
+	configuration (solver, classWeight, C), which warm-starts when its solver
+	can.
+	"""
+	from sklearn import linear_model
+	# liblinear ignores warm_start
+	return linear_model.LogisticRegression(solver=solver, class_weight=classWeight, C=C, \
+		multi_class='ovr', max_iter=MAX_ITER, warm_start=solver != 'liblinear')
+
+# State of a worker process of selectModel(), set by initCvWorker(): the
+# training data and the (train rows, test rows) of every fold.
+cvWorker = {}
+
+def initCvWorker(X, Y, folds):
+	"""
+	Runs in each worker process of selectModel() when it starts. The
+	arguments are inherited from the parent process rather than pickled.
+	"""
+	cvWorker['X'] = X
+	cvWorker['Y'] = Y
+	cvWorker['folds'] = folds
+
+def crossValidatePath(task):
+	"""
+	Runs in a worker process of selectModel(): fits the (solver, classWeight,
+	fold) |task| for every C of GRID in increasing order, reusing one
+	classifier so that each fit warm-starts from the previous one, and scores
+	each fit on the held-out rows of the fold.
+
+	@return results: A list of one dict per C with the configuration, the
+		fold, the fit time in seconds, the number of iterations, whether the
+		solver converged, and the accuracy and macro-averaged F1 score.
+	"""
+	from sklearn import exceptions, metrics
+	solver, classWeight, fold = task
+	trainRows, testRows = cvWorker['folds'][fold]
+	trainX, trainY = cvWorker['X'][trainRows], cvWorker['Y'][trainRows]
+	testX, testY = cvWorker['X'][testRows], cvWorker['Y'][testRows]
+	classifier = None
+	results = []
+	for C in sorted(GRID['C']):
+		if classifier is None:
+			classifier = makeClassifier(solver, classWeight, C)
+		else:
+			classifier.set_params(C=C)
+		start = time.time()
+		with warnings.catch_warnings():
+			# reported as 'converged' instead
+			warnings.simplefilter('ignore', exceptions.ConvergenceWarning)
+			classifier.fit(trainX, trainY)
+		seconds = time.time() - start
+		predicted = classifier.predict(testX)
+		iterations = int(np.max(classifier.n_iter_))
+		with warnings.catch_warnings():
+			# a cuisine never predicted scores an F1 of 0
+			warnings.simplefilter('ignore', exceptions.UndefinedMetricWarning)
+			macroF1 = metrics.f1_score(testY, predicted, average='macro')
+		results.append({'solver': solver, 'classWeight': classWeight, 'C': C, 'fold': fold,
+			'seconds': seconds, 'iterations': iterations, 'converged': iterations < MAX_ITER,
+			'accuracy': metrics.accuracy_score(testY, predicted), 'macroF1': macroF1})
+	return results
+
+def selectModel(X, Y, folds=FOLDS, processes=None, seed=0, output=sys.stdout):
+	"""
+	Cross-validates every configuration of GRID on |folds| stratified folds
+	of the training data (X, Y), with the (solver, class weight, fold) paths
+	run in parallel on |processes| worker processes (by default one per CPU),
+	and prints the mean scores and fit time of every configuration to
+	|output|, best first. The configurations are ranked by macro-averaged F1,
+	which weighs every cuisine equally despite the imbalance of the labels.
+
+	@return (config, report): The best configuration as a dict of
+		makeClassifier() arguments, and the list of the rows of the report,
+		each a dict with the configuration, its mean accuracy and macro F1,
+		the standard deviation of its macro F1 and its total fit seconds.
+	"""
+	from sklearn import model_selection
+	Y = np.asarray(Y)
+	folds = list(model_selection.StratifiedKFold(folds, shuffle=True, random_state=seed).split(X, Y))
+	tasks = list(itertools.product(GRID['solver'], GRID['classWeight'], range(len(folds))))
+	start = time.time()
+	# The workers are forked after the data is loaded and share it.
+	pool = multiprocessing.Pool(processes, initCvWorker, (X, Y, folds))
+	try:
+		results = [result for path in pool.imap_unordered(crossValidatePath, tasks) \
+			for result in path]
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+	seconds = time.time() - start
+
+	byConfig = collections.defaultdict(list)
+	for result in results:
+		byConfig[(result['solver'], result['classWeight'], result['C'])].append(result)
+	report = []
+	for (solver, classWeight, C), configResults in byConfig.iteritems():
+		macroF1 = [result['macroF1'] for result in configResults]
+		report.append({'solver': solver, 'classWeight': classWeight, 'C': C,
+			'accuracy': np.mean([result['accuracy'] for result in configResults]),
+			'macroF1': np.mean(macroF1), 'macroF1Std': np.std(macroF1),
+			'seconds': sum(result['seconds'] for result in configResults),
+			'iterations': np.mean([result['iterations'] for result in configResults]),
+			'converged': all(result['converged'] for result in configResults)})
+	# ties go to the stronger regularization
+	report.sort(key=lambda row: (-row['macroF1'], row['C'], row['solver']))
+	print >>output, "%-10s %-9s %8s %9s %9s %8s %10s %10s" % ("solver", "weights", "C", \
+		"macro F1", "+-", "accuracy", "fit (s)", "iterations")
+	for row in report:
+		print >>output, "%-10s %-9s %8g %9.4f %9.4f %8.4f %10.3f %10s" % (row['solver'], \
+			row['classWeight'] or 'none', row['C'], row['macroF1'], row['macroF1Std'], \
+			row['accuracy'], row['seconds'], '%.0f%s' % (row['iterations'], \
+			'' if row['converged'] else '*'))
+	print >>output, "%d fits in %.2f s (* did not converge in %d iterations)" % (len(results), \
+		seconds, MAX_ITER)
+	best = report[0]
+	return {'solver': best['solver'], 'classWeight': best['classWeight'], 'C': best['C']}, report
+
+def train(dataPath, modelPath, folds=FOLDS, processes=None):
+	"""
+	Trains the classifier on the labeled recipes of |dataPath| and saves it
+	with its vocabulary and labels as a CuisineModel in |modelPath|. The
+	configuration is chosen by selectModel() with |folds| folds, or is the
+	default LogisticRegression if |folds| is 0.
+	"""
+	trainX, trainY, ingredientIndex, cuisineMap, trainIngredientsList = process(dataPath)
+	info = {'data': dataPath, 'recipes': len(trainY)}
+	if folds:
+		config, report = selectModel(trainX, trainY, folds, processes)
+		predictor = makeClassifier(**config)
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore')
+			predictor.fit(trainX, trainY)
+		info.update(config=config, folds=folds, macroF1=report[0]['macroF1'], \
+			accuracy=report[0]['accuracy'])
+	else:
+		predictor = predictCuisine(trainX, trainY)
+	vocabulary = sorted(ingredientIndex, key=ingredientIndex.get)
+	model = cuisineModel.from_sklearn(predictor, vocabulary, oppMap, info)
+	model.save(modelPath)
+	return model
 
-trainX, trainY, ingredientSet, cuisineMap, trainIngredientsList = process("./data.csv")
-predictor = predictCuisine(trainX, trainY)
-recipeIngredientsList = readIngredients(predictor, ingredientSet)
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Train the cuisine classifier or label the recipes with it.')
+	parser.add_argument('command', choices=['train', 'predict'])
+	parser.add_argument('--data', default='./data.csv', help='labeled recipes to train on')
+	parser.add_argument('--model', default=modelPath, help='model directory')
+	parser.add_argument('--folds', type=int, default=FOLDS, \
+		help='cross-validation folds of the model selection, 0 to train the default model')
+	parser.add_argument('--processes', type=int, help='training processes (default: CPUs)')
+	args = parser.parse_args()
+	if args.command == 'train':
+		train(args.data, args.model, args.folds, args.processes)
+	else:
+		readIngredients(cuisineModel.load_model(args.model))
@@ -1,4 +1,13 @@
-import sys, copy
+import bisect, collections, itertools, math, multiprocessing, time
+import numpy as np
+
+# On a compiled CSP, AC-3 revises an arc with NumPy once the domains of its
+# two variables have more than this many pairs of values left.
+AC3_VECTOR_PAIRS = 256
+
+# Deepest level at which solve_parallel() cuts the search tree by default.
+MAX_SPLIT_DEPTH = 16
+
 # A backtracking algorithm that solves weighted CSP.
 # Usage:
 #   search = BacktrackingSearch()
@@ -28,7 +37,7 @@ class BacktrackingSearch():
         # assignment (doesn't have to be optimal).
         self.firstAssignmentNumOperations = 0
 
-        # List of all solutions found.
+        # List of all solutions found, only filled by solve(keep_all = True).
         self.allAssignments = []
 
     def print_stats(self):
@@ -41,6 +50,8 @@ class BacktrackingSearch():
             print "First assignment took %d operations" % self.firstAssignmentNumOperations
         else:
             print "No solution was found."
+        if self.budgetExhausted:
+            print "Search budget exhausted, the best assignment found so far is kept."
 
     def get_delta_weight(self, assignment, var, val):
         """
@@ -60,16 +71,45 @@ class BacktrackingSearch():
         """
         assert var not in assignment
         w = 1.0
-        if self.csp.unaryFactors[var]:
+        if self.csp.unaryFactors[var] is not None:
             w *= self.csp.unaryFactors[var][val]
             if w == 0: return w
-        for var2, factor in self.csp.binaryFactors[var].iteritems():
+        if self.compiled:
+            neighbors = self.csp.neighborFactors[var]
+        else:
+            neighbors = self.csp.binaryFactors[var].iteritems()
+        for var2, factor in neighbors:
             if var2 not in assignment: continue  # Not assigned yet
             w *= factor[val][assignment[var2]]
             if w == 0: return w
         return w
 
-    def solve(self, csp, mcv = False, ac3 = False):
+    def get_delta_weights(self, assignment, var, values):
+        """
+        Returns the list of the delta weights (see get_delta_weight()) of
+        assigning each of |values| to the unassigned variable |var|. On a
+        compiled CSP they are computed for all the values at once, one assigned
+        neighbor at a time, instead of one value at a time; the products are
+        formed in the same order, so the weights are the same.
+        """
+        if not self.compiled:
+            return [self.get_delta_weight(assignment, var, val) for val in values]
+        unary = self.csp.unaryFactors[var]
+        if unary is None:
+            weights = [1.0] * len(values)
+        else:
+            weights = [unary[val] for val in values]
+        binaryFactors = self.csp.binaryFactors
+        for var2 in self.csp.neighbors[var]:
+            if var2 not in assignment: continue  # Not assigned yet
+            # the factor row of the neighbor's value, over the values of var
+            row = binaryFactors[var2][var][assignment[var2]]
+            weights = [w * row[val] for w, val in zip(weights, values)]
+        return weights
+
+    def solve(self, csp, mcv = False, ac3 = False, compiled = False, \
+            optimize = False, maxNodes = None, timeLimit = None, keep_all = False, \
+            iterative = False, stats = None):
         """
         Solves the given weighted CSP using heuristics as specified in the
         parameter. Note that unlike a typical unweighted CSP where the search
@@ -81,23 +121,348 @@ class BacktrackingSearch():
         @param mcv: When enabled, Most Constrained Variable heuristics is used.
         @param ac3: When enabled, AC-3 will be used after each assignment of an
             variable is made.
+        @param compiled: When enabled, the search runs on csp.compile(), the
+            integer-indexed form of the CSP. The results are translated back
+            and are identical to the dict-based search. It is faster when the
+            variables or values are costly to hash, like the (recipe, meal)
+            pairs of a meal plan, and about even on small integer CSPs (see
+            'python benchmark.py compiled').
+        @param optimize: When enabled, only the optimal assignment is searched
+            for: subtrees whose weight bound falls below the best weight found
+            so far are pruned. The optimal weight, assignment and count are the
+            same as without it.
+        @param maxNodes: If set, stop after this many calls to backtrack().
+        @param timeLimit: If set, stop after this many seconds. When the search
+            is stopped early, budgetExhausted is set and the best assignment
+            found so far is kept.
+        @param keep_all: When enabled, every solution found is also stored in
+            allAssignments. This can take a lot of memory on loose CSPs; use
+            iter_solutions() to process the solutions one at a time instead.
+        @param iterative: When enabled, the search runs on an explicit stack
+            (backtrack_iterative()) instead of recursing once per variable.
+        @param stats: If set, a solverStats.SolverStats that records the time of
+            the 'solve' phase, setup of the search included, and the statistics
+            of the search.
+        """
+        if stats is None:
+            for assignment in self.iter_solutions(csp, mcv, ac3, compiled, optimize, \
+                    maxNodes, timeLimit, iterative = iterative):
+                if keep_all:
+                    self.allAssignments.append(assignment)
+        else:
+            with stats.phase('solve'):
+                for assignment in self.iter_solutions(csp, mcv, ac3, compiled, optimize, \
+                        maxNodes, timeLimit, iterative = iterative, stats = stats):
+                    if keep_all:
+                        self.allAssignments.append(assignment)
+        # Print summary of solutions.
+        self.print_stats()
+
+    def iter_solutions(self, csp, mcv = False, ac3 = False, compiled = False, \
+            optimize = False, maxNodes = None, timeLimit = None, limit = None, \
+            iterative = False, stats = None):
+        """
+        Returns an iterator over the solutions of the given weighted CSP, found
+        lazily in search order. The statistics described in reset_results()
+        are kept up to date as the search goes, so they are correct whenever
+        the iteration stops. In optimize mode only the solutions that are at
+        least as good as the best one found before them are produced.
+
+        The parameters are the same as for solve(), plus:
+        @param limit: If set, stop after this many solutions.
+
+        @return solutions: An iterator of assignments, each a new dictionary
+            from variable to value.
+        """
+        self.start_search(csp, mcv, ac3, compiled, optimize, maxNodes, timeLimit, \
+            stats = stats)
+        # Perform backtracking search.
+        if not self.rootConsistent:
+            solutions = iter([])
+        elif iterative:
+            solutions = self.backtrack_iterative(self.assignment, 0, 1)
+        else:
+            solutions = self.backtrack(self.assignment, 0, 1)
+        if limit is not None:
+            solutions = itertools.islice(solutions, limit)
+        return solutions
+
+    def solve_parallel(self, csp, mcv = False, ac3 = False, compiled = False, \
+            optimize = False, maxNodes = None, timeLimit = None, keep_all = False, \
+            iterative = False, processes = None, splitDepth = None):
+        """
+        Solves the given weighted CSP like solve(), with the search tree split
+        among a pool of worker processes. The tree is cut after the first
+        |splitDepth| variables picked by the heuristics, and the subtrees below
+        the cut are searched in parallel. In optimize mode the workers share
+        the best weight found so far, so each prunes against the best of all.
+
+        The optimal weight, assignment and count are the same as those of
+        solve(), and so is allAssignments with keep_all. numOperations and
+        numAssignments add up the work of all workers, and
+        firstAssignmentNumOperations counts the nodes a serial run would have
+        visited before the first solution; they can differ from a serial run
+        in optimize mode since pruning depends on timing. maxNodes
+        applies to each subtree, while timeLimit counts from the start of the
+        whole search.
+
+        The parameters are the same as for solve(), plus:
+        @param processes: Number of worker processes, all cores by default.
+        @param splitDepth: Depth of the cut. By default it is the first level
+            with at least four subtrees per worker, at most MAX_SPLIT_DEPTH
+            levels down, or the first level that does not branch (e.g. forced
+            values); if that leaves a single subtree, the search runs serially
+            with solve().
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.start_search(csp, mcv, ac3, compiled, optimize, maxNodes, timeLimit)
+        if self.csp.numVars <= 1 or not self.rootConsistent:
+            return self.solve(csp, mcv, ac3, compiled, optimize, maxNodes, timeLimit, \
+                keep_all, iterative)
+
+        # Find the subtrees below the cut, each given by the list of (var, val)
+        # assignments leading to it and its weight, in search order.
+        if splitDepth is not None:
+            subtrees = self.split_subtrees(min(splitDepth, self.csp.numVars - 1))
+        else:
+            subtrees = self.split_subtrees(min(MAX_SPLIT_DEPTH, self.csp.numVars - 1), \
+                4 * processes)
+            if len(subtrees) < 2 and not self.budgetExhausted:
+                return self.solve(csp, mcv, ac3, compiled, optimize, maxNodes, timeLimit, \
+                    keep_all, iterative)
+
+        if optimize:
+            sharedBest = multiprocessing.RawValue('d', 0.0)
+            sharedLock = multiprocessing.Lock()
+        else:
+            sharedBest = sharedLock = None
+        options = (mcv, ac3, compiled, optimize, maxNodes, timeLimit, self.startTime, \
+            iterative, keep_all)
+        pool = multiprocessing.Pool(processes, init_subtree_worker, \
+            (self.csp, options, sharedBest, sharedLock))
+        # the operations of the subtrees merged so far
+        subtreeOperations = 0
+        try:
+            # Merge the results in search order, exactly as the serial search
+            # would have met the solutions of each subtree.
+            for (prefix, weight, splitOperations), result in zip(subtrees, \
+                    pool.imap(search_subtree, [subtree[:2] for subtree in subtrees])):
+                if keep_all:
+                    self.allAssignments.extend(result['allAssignments'])
+                if result['optimalAssignment'] and (not self.optimalAssignment or \
+                        result['optimalWeight'] >= self.optimalWeight):
+                    if result['optimalWeight'] == self.optimalWeight:
+                        self.numOptimalAssignments += result['numOptimalAssignments']
+                    else:
+                        self.numOptimalAssignments = result['numOptimalAssignments']
+                    self.optimalWeight = result['optimalWeight']
+                    self.optimalAssignment = result['optimalAssignment']
+                    if self.firstAssignmentNumOperations == 0:
+                        # the serial search visits the split nodes before the
+                        # subtree and the earlier subtrees first
+                        self.firstAssignmentNumOperations = splitOperations + \
+                            subtreeOperations + result['firstAssignmentNumOperations']
+                subtreeOperations += result['numOperations']
+                self.numOperations += result['numOperations']
+                self.numAssignments += result['numAssignments']
+                self.budgetExhausted = self.budgetExhausted or result['budgetExhausted']
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        # Print summary of solutions.
+        self.print_stats()
+
+    def solve_decomposed(self, csp, mcv = False, ac3 = False, compiled = False, \
+            optimize = False, maxNodes = None, timeLimit = None, keep_all = False, \
+            iterative = False, processes = 1):
+        """
+        Solves the given weighted CSP like solve(), one connected component of
+        its constraint graph at a time (see CSP.get_components()). The weight
+        of an assignment is the product of the weights of its parts on each
+        component, so the optimum is made of the optimum of every component,
+        and the search no longer multiplies the subtrees of independent
+        components. Components that are trees of binary factors are solved
+        exactly by dynamic programming (see solve_tree()) instead of
+        backtracking, unless keep_all asks for all their solutions.
+
+        The optimal weight and count are the same as those of solve(), and
+        outside optimize mode so is numAssignments; the optimal assignment may
+        differ among ties. numOperations adds up the calls to backtrack() of
+        all components. maxNodes applies to each component, while timeLimit
+        counts from the start of the whole search. With keep_all,
+        allAssignments holds every combination of the solutions kept for each
+        component.
+
+        The parameters are the same as for solve(), plus:
+        @param processes: Number of worker processes searching the components
+            that are not trees, or 1 to search them in this process.
+        """
+        self.reset_results()
+        self.budgetExhausted = False
+        components = csp.get_components()
+        results = [None] * len(components)
+        searched = []
+        for i, component in enumerate(components):
+            if not keep_all and csp.is_tree(component):
+                results[i] = solve_tree(csp, component)
+            else:
+                searched.append(i)
+        # a CSP of a single component is searched as it is
+        subCSPs = [csp if len(components) == 1 else csp.get_sub_csp(components[i]) \
+            for i in searched]
+        options = (mcv, ac3, compiled, optimize, maxNodes, timeLimit, time.time(), \
+            iterative, keep_all)
+        if processes > 1 and len(subCSPs) > 1:
+            pool = multiprocessing.Pool(min(processes, len(subCSPs)), init_component_worker, \
+                (subCSPs, options))
+            try:
+                for i, result in zip(searched, pool.imap(search_component, range(len(subCSPs)))):
+                    results[i] = result
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for i, subCSP in zip(searched, subCSPs):
+                results[i] = search_csp(subCSP, options)
+
+        for result in results:
+            self.numOperations += result['numOperations']
+            self.budgetExhausted = self.budgetExhausted or result['budgetExhausted']
+        if all(result['optimalAssignment'] for result in results):
+            self.optimalWeight = 1
+            self.numOptimalAssignments = 1
+            self.numAssignments = 1
+            for result in results:
+                self.optimalWeight *= result['optimalWeight']
+                self.optimalAssignment.update(result['optimalAssignment'])
+                self.numOptimalAssignments *= result['numOptimalAssignments']
+                self.numAssignments *= result['numAssignments']
+                self.firstAssignmentNumOperations += result['firstAssignmentNumOperations']
+            if keep_all:
+                for parts in itertools.product(*[result['allAssignments'] for result in results]):
+                    assignment = {}
+                    for part in parts:
+                        assignment.update(part)
+                    self.allAssignments.append(assignment)
+        # Print summary of solutions.
+        self.print_stats()
+
+    def split_subtrees(self, maxDepth, minSubtrees = None):
+        """
+        Cut the search tree into the subtrees searched by the workers of
+        solve_parallel(), one level at a time: every node of a level is
+        expanded like backtrack() does to make the next level, its search
+        state being rebuilt by assigning its prefix from the root. Without
+        |minSubtrees| the cut is at depth |maxDepth|. With it, the cut is at
+        the first level with at least |minSubtrees| nodes, at |maxDepth| at
+        the latest, or at the first level with no more nodes than the one
+        above it. If the budget runs out, the nodes left unexpanded are
+        returned as they are.
+
+        @return subtrees: The list of (prefix, weight, numOperations) triples
+            of the nodes at the cut in search order, where prefix is the list
+            of (var, val) assignments leading to the node and numOperations
+            the number of expanded nodes that backtrack() visits before it.
+        """
+        # Each node carries the positions of its prefix among its siblings,
+        # which sort the nodes in the order backtrack() visits them.
+        frontier = [([], 1, ())]
+        expanded = []
+        for depth in xrange(maxDepth):
+            children = []
+            stopped = False
+            for i, (prefix, weight, position) in enumerate(frontier):
+                if self.budgetExhausted or self.check_budget():
+                    children += frontier[i:]
+                    stopped = True
+                    break
+                self.numOperations += 1
+                expanded.append(position)
+                # consistent, as checked when the prefix was added
+                marks = [self.assign_value(var, val)[0] for var, val in prefix]
+                var = self.get_unassigned_variable(self.assignment)
+                values = self.get_domain_values(var)
+                numChildren = 0
+                for val, deltaWeight in zip(values, \
+                        self.get_delta_weights(self.assignment, var, values)):
+                    if deltaWeight > 0:
+                        mark, consistent = self.assign_value(var, val)
+                        if consistent:
+                            children.append((prefix + [(var, val)], weight * deltaWeight, \
+                                position + (numChildren,)))
+                            numChildren += 1
+                        self.unassign_value(var, val, mark)
+                for (var, val), mark in reversed(zip(prefix, marks)):
+                    self.unassign_value(var, val, mark)
+            grew = len(children) > len(frontier)
+            frontier = children
+            if stopped or minSubtrees is not None and (len(frontier) >= minSubtrees or not grew):
+                break
+        expanded.sort()
+        return [(prefix, weight, bisect.bisect_left(expanded, position)) \
+            for prefix, weight, position in frontier]
+
+    def start_search(self, csp, mcv, ac3, compiled, optimize, maxNodes, timeLimit, \
+            startTime = None, sharedBest = None, sharedLock = None, stats = None):
+        """
+        Reset the results and set up the state of a new search of |csp| with
+        the options of solve(), leaving it at the root with nothing assigned.
+
+        @param startTime: The time the time budget is counted from, if not now.
+        @param sharedBest: A multiprocessing.RawValue holding the best weight
+            found by any worker of solve_parallel(), guarded by |sharedLock|.
+        @param stats: The solverStats.SolverStats to record the search in, or
+            None.
         """
-        # CSP to be solved.
-        self.csp = csp
+        # CSP to be solved. A CompiledCSP compiles to itself.
+        self.compiled = compiled
+        self.csp = csp.compile() if compiled else csp
 
         # Set the search heuristics requested asked.
         self.mcv = mcv
         self.ac3 = ac3
+        self.optimize = optimize
+
+        # Node and time budget of the search.
+        self.maxNodes = maxNodes
+        self.timeLimit = timeLimit
+        self.startTime = time.time() if startTime is None else startTime
+        self.budgetExhausted = False
+        # Best weight found by any process of a parallel search, with its lock.
+        self.sharedBest = sharedBest
+        self.sharedLock = sharedLock
+        self.stats = stats
 
         # Reset solutions from previous search.
         self.reset_results()
 
-        # The dictionary of domains of every variable in the CSP.
-        self.domains = {var: list(self.csp.values[var]) for var in self.csp.variables}
-        # Perform backtracking search.
-        self.backtrack({}, 0, 1)
-        # Print summary of solutions.
-        self.print_stats()
+        # The domains of every variable in the CSP, as lists of values in
+        # domain order: a dictionary keyed by variable, or for a compiled CSP a
+        # list of lists of value indices.
+        if self.compiled:
+            self.domains = [list(values) for values in self.csp.values]
+        else:
+            self.domains = {var: list(self.csp.values[var]) for var in self.csp.variables}
+        # Undo log of every change made to self.domains during the search. Each
+        # entry is (var, index, val) for a value pruned at |index|, or
+        # (var, None, oldDomain) when the whole domain of |var| was replaced.
+        self.trail = []
+        # The current partial assignment, shared with backtrack().
+        self.assignment = {}
+        if self.stats is not None:
+            self.stats.start_search(self.domains)
+        if self.mcv:
+            self.init_live_counts()
+        if self.optimize:
+            self.init_weight_bounds()
+        # The search state of each global constraint, and whether propagating
+        # them at the root left the CSP satisfiable.
+        self.globalStates = [constraint.initial_state() \
+            for constraint in self.csp.globalConstraints]
+        self.rootConsistent = self.propagate_global_constraints()
 
     def backtrack(self, assignment, numAssigned, weight):
         """
@@ -110,65 +475,329 @@ class BacktrackingSearch():
             and 6 was assigned to it, then assignment[A] == 6.
         @param numAssigned: Number of currently assigned variables
         @param weight: The weight of the current partial assignment.
+
+        @return solutions: A generator of the solutions below this node, each a
+            new dictionary from variable to value.
         """
+        if self.budgetExhausted or self.check_budget(): return
         self.numOperations += 1
+        if self.stats is not None: self.stats.visit(numAssigned, len(self.trail))
         assert weight > 0
         if numAssigned == self.csp.numVars:
-            # A satisfiable solution have been found. Update the statistics.
-            self.numAssignments += 1
-            newAssignment = {}
-            for var in self.csp.variables:
-                newAssignment[var] = assignment[var]
-            self.allAssignments.append(newAssignment)
-
-            if len(self.optimalAssignment) == 0 or weight >= self.optimalWeight:
-                if weight == self.optimalWeight:
-                    self.numOptimalAssignments += 1
-                else:
-                    self.numOptimalAssignments = 1
-                self.optimalWeight = weight
-
-                self.optimalAssignment = newAssignment
-                if self.firstAssignmentNumOperations == 0:
-                    self.firstAssignmentNumOperations = self.numOperations
+            solution = self.record_solution(assignment, weight)
+            if solution is not None:
+                yield solution
             return
     
         # Select the next variable to be assigned.
         var = self.get_unassigned_variable(assignment)
         # Get an ordering of the values.
-        ordered_values = self.domains[var]
+        ordered_values = self.get_domain_values(var)
 
         # Continue the backtracking recursion using |var| and |ordered_values|.
-        if not self.ac3:
-            # When arc consistency check is not enabled.
-            for val in ordered_values:
-                deltaWeight = self.get_delta_weight(assignment, var, val)
-                if deltaWeight > 0:
-                    assignment[var] = val
-                    self.backtrack(assignment, numAssigned + 1, weight * deltaWeight)
-                    del assignment[var]
-        else:
+        deltaWeights = self.get_delta_weights(assignment, var, ordered_values)
+        for val, deltaWeight in zip(ordered_values, deltaWeights):
+            if deltaWeight > 0:
+                if self.optimize and not self.within_bound(var, weight * deltaWeight):
+                    continue
+                mark, consistent = self.assign_value(var, val)
+                if consistent:
+                    for solution in self.backtrack(assignment, numAssigned + 1, \
+                            weight * deltaWeight):
+                        yield solution
+                self.unassign_value(var, val, mark)
+                if self.budgetExhausted: return
+
+    def backtrack_iterative(self, assignment, numAssigned, weight):
+        """
+        The same search as backtrack(), visiting the same nodes in the same
+        order and keeping the same statistics, but driven by an explicit stack
+        instead of recursion, so that it is not bounded by the Python recursion
+        limit on CSPs with thousands of variables. The parameters are the same
+        as for backtrack().
+
+        @return solutions: A generator of the solutions below this node, each a
+            new dictionary from variable to value.
+        """
+        # One frame per variable picked on the current path: [var, ordered
+        # values, index of the next value to try, weight of the node, value
+        # currently assigned, trail mark of that assignment or None, delta
+        # weights of the ordered values].
+        stack = []
+        while True:
+            # Visit the node of the current partial assignment.
+            if self.budgetExhausted or self.check_budget(): break
+            self.numOperations += 1
+            if self.stats is not None:
+                self.stats.visit(numAssigned + len(stack), len(self.trail))
+            assert weight > 0
+            if numAssigned + len(stack) == self.csp.numVars:
+                solution = self.record_solution(assignment, weight)
+                if solution is not None:
+                    yield solution
+            else:
+                var = self.get_unassigned_variable(assignment)
+                ordered_values = self.get_domain_values(var)
+                stack.append([var, ordered_values, 0, weight, None, None, \
+                    self.get_delta_weights(assignment, var, ordered_values)])
+
+            # Move on to the next child to visit, backing up the stack as the
+            # values of variables run out.
+            while stack:
+                frame = stack[-1]
+                var, ordered_values = frame[0], frame[1]
+                if frame[5] is not None:
+                    self.unassign_value(var, frame[4], frame[5])
+                    frame[5] = None
+                    if self.budgetExhausted: break  # undo the rest below
+                while frame[2] < len(ordered_values):
+                    val = ordered_values[frame[2]]
+                    deltaWeight = frame[6][frame[2]]
+                    frame[2] += 1
+                    if deltaWeight > 0:
+                        if self.optimize and not self.within_bound(var, frame[3] * deltaWeight):
+                            continue
+                        mark, consistent = self.assign_value(var, val)
+                        if not consistent:
+                            self.unassign_value(var, val, mark)
+                            continue
+                        frame[4] = val
+                        frame[5] = mark
+                        weight = frame[3] * deltaWeight
+                        break
+                if frame[5] is not None: break
+                stack.pop()
+            else:
+                return
+
+        # The budget ran out: undo the assignments still on the stack.
+        for frame in reversed(stack):
+            if frame[5] is not None:
+                self.unassign_value(frame[0], frame[4], frame[5])
+
+    def record_solution(self, assignment, weight):
+        """
+        Update the statistics for a complete |assignment| of weight |weight|.
+
+        @return solution: A copy of the assignment, or None if it should not be
+            produced because the search is optimizing and it is not among the
+            best found so far.
+        """
+        # A satisfiable solution have been found. Update the statistics.
+        self.numAssignments += 1
+        newAssignment = self.csp.decode(assignment)
+
+        if len(self.optimalAssignment) == 0 or weight >= self.optimalWeight:
+            if weight == self.optimalWeight:
+                self.numOptimalAssignments += 1
+            else:
+                self.numOptimalAssignments = 1
+            self.optimalWeight = weight
+
+            self.optimalAssignment = newAssignment
+            if self.firstAssignmentNumOperations == 0:
+                self.firstAssignmentNumOperations = self.numOperations
+            if self.sharedBest is not None and weight > self.sharedBest.value:
+                # let the other workers prune against this weight too
+                with self.sharedLock:
+                    if weight > self.sharedBest.value:
+                        self.sharedBest.value = weight
+            return newAssignment
+        if self.optimize:
+            return None
+        return newAssignment
+
+    def assign_value(self, var, val):
+        """
+        Assign |val| to the unassigned variable |var| and update all the search
+        state that depends on it: the MCV counts, the weight bound, the global
+        constraints and, with AC-3, the domains of the other variables.
+
+        @return (mark, consistent): The length of the trail before the
+            assignment, to be passed to unassign_value() whether or not the
+            assignment is consistent, and False if propagating the global
+            constraints showed that it cannot lead to a solution.
+        """
+        self.assignment[var] = val
+        if self.mcv: self.count_assignment(var, val, 1)
+        if self.optimize:
+            self.boundStack.append((self.logRemainingBound, self.numZeroFactors))
+            if self.logMaxFactors[var] is None:
+                self.numZeroFactors -= 1
+            else:
+                self.logRemainingBound -= self.logMaxFactors[var]
+        # remember where the trail ends, as we are going to look
+        # ahead and change domain values
+        mark = len(self.trail)
+        consistent = self.propagate_global_constraints(var, val)
+        if self.ac3 and consistent:
             # Arc consistency check is enabled.
             # Problem 1c: skeleton code for AC-3
             # You need to implement arc_consistency_check().
-            for val in ordered_values:
-                deltaWeight = self.get_delta_weight(assignment, var, val)
-                if deltaWeight > 0:
-                    assignment[var] = val
-                    # create a deep copy of domains as we are going to look
-                    # ahead and change domain values
-                    localCopy = copy.deepcopy(self.domains)
-                    # fix value for the selected variable so that hopefully we
-                    # can eliminate values for other variables
-                    self.domains[var] = [val]
-
-                    # enforce arc consistency
-                    self.arc_consistency_check(var)
-
-                    self.backtrack(assignment, numAssigned + 1, weight * deltaWeight)
-                    # restore the previous domains
-                    self.domains = localCopy
-                    del assignment[var]
+            # fix value for the selected variable so that hopefully we
+            # can eliminate values for other variables
+            self.trail.append((var, None, self.domains[var]))
+            self.domains[var] = [val]
+
+            # enforce arc consistency
+            self.arc_consistency_check(var)
+        return mark, consistent
+
+    def unassign_value(self, var, val, mark):
+        """
+        Undo assign_value(var, val), which returned |mark|.
+        """
+        # restore the previous domains
+        self.restore_domains(mark)
+        for index in self.csp.variableConstraints[var]:
+            self.csp.globalConstraints[index].assign(self.globalStates[index], var, val, -1)
+        if self.optimize:
+            self.logRemainingBound, self.numZeroFactors = self.boundStack.pop()
+        if self.mcv: self.count_assignment(var, val, -1)
+        del self.assignment[var]
+        if self.stats is not None: self.stats.backtrack(len(self.assignment))
+
+    def init_weight_bounds(self):
+        """
+        Set up the weight bound used when optimizing. The delta weight of
+        assigning |var| can be at most the largest unary factor value in its
+        domain, times the largest binary factor values, which are only counted
+        in the bound when they exceed 1. So no completion of a partial
+        assignment of weight w can weigh more than
+          w * (product of the binary maxima) * (product of the unary maxima of
+          the unassigned variables)
+        The products overflow on CSPs with hundreds of variables, so they are
+        kept as sums of logarithms: self.logBinaryBound, and
+        self.logRemainingBound over the unassigned variables whose maximum is
+        positive. self.logMaxFactors[var] is the logarithm of the maximum of
+        var, or None if it is 0, and self.numZeroFactors counts the unassigned
+        variables with a maximum of 0, which make the bound 0.
+        """
+        self.logMaxFactors = {}
+        self.logRemainingBound = 0.0
+        self.numZeroFactors = 0
+        self.boundStack = []
+        for var in self.csp.variables:
+            unary = self.csp.unaryFactors[var]
+            if unary is None:
+                maxFactor = 1.0
+            else:
+                maxFactor = float(max([unary[val] for val in self.csp.values[var]] or [0.0]))
+            if maxFactor > 0:
+                self.logMaxFactors[var] = math.log(maxFactor)
+                self.logRemainingBound += self.logMaxFactors[var]
+            else:
+                self.logMaxFactors[var] = None
+                self.numZeroFactors += 1
+
+        self.logBinaryBound = 0.0
+        order = {var: i for i, var in enumerate(self.csp.variables)}
+        for var1 in self.csp.variables:
+            for var2 in self.csp.get_neighbor_vars(var1):
+                if order[var2] < order[var1]: continue
+                factor = self.csp.binaryFactorArrays[var1][var2]
+                if factor.size and factor.max() > 1:
+                    self.logBinaryBound += math.log(float(factor.max()))
+
+    def within_bound(self, var, weight):
+        """
+        Returns False if no solution extending the current assignment with
+        |var| assigned, at a weight of |weight|, can be as good as the best
+        solution found so far. A small tolerance keeps rounding errors in the
+        bound from pruning solutions that tie with the best one.
+        """
+        best = self.optimalWeight
+        if self.sharedBest is not None:
+            best = max(best, self.sharedBest.value)
+        if best <= 0: return True
+        # the bound is 0 if another unassigned variable has a maximum of 0
+        if self.numZeroFactors > (self.logMaxFactors[var] is None): return False
+        logBound = math.log(weight) + self.logBinaryBound + self.logRemainingBound
+        if self.logMaxFactors[var] is not None:
+            logBound -= self.logMaxFactors[var]
+        return logBound >= math.log(best) + math.log1p(-1e-9)
+
+    def check_budget(self):
+        """
+        Returns True, and sets budgetExhausted, once the node or time budget
+        of the search is used up. The clock is only read every 256 nodes.
+        """
+        if self.maxNodes is not None and self.numOperations >= self.maxNodes:
+            self.budgetExhausted = True
+        elif self.timeLimit is not None and self.numOperations % 256 == 0 and \
+                time.time() - self.startTime > self.timeLimit:
+            self.budgetExhausted = True
+        return self.budgetExhausted
+
+    def restore_domains(self, mark):
+        """
+        Undo every domain change recorded on the trail after position |mark|,
+        most recent first, so each domain gets back its exact previous order.
+
+        @param mark: Length of self.trail before the changes were made.
+        """
+        while len(self.trail) > mark:
+            var, index, val = self.trail.pop()
+            if index is None:
+                self.domains[var] = val
+            else:
+                self.domains[var].insert(index, val)
+                if self.mcv: self.update_dead_counts(var, [val], -1)
+
+    def propagate_global_constraints(self, var = None, val = None):
+        """
+        Update the states of the global constraints involving |var| for its new
+        value |val| and run their propagation, or at the root (|var| is None)
+        propagate all of them.
+
+        @return consistent: False if some global constraint can no longer be
+            satisfied.
+        """
+        if var is None:
+            indices = range(len(self.csp.globalConstraints))
+        else:
+            indices = self.csp.variableConstraints[var]
+            for index in indices:
+                self.csp.globalConstraints[index].assign(self.globalStates[index], var, val, 1)
+        for index in indices:
+            if not self.csp.globalConstraints[index].propagate(self.globalStates[index], \
+                    self, var):
+                return False
+        return True
+
+    def prune_value(self, var, val):
+        """
+        Remove |val| from the domain of |var|, recording it on the trail.
+
+        @return pruned: False if |val| was not in the domain anymore.
+        """
+        domain = self.domains[var]
+        if val not in domain: return False
+        index = domain.index(val)
+        del domain[index]
+        self.trail.append((var, index, val))
+        if self.mcv: self.update_dead_counts(var, [val], 1)
+        if self.stats is not None: self.stats.propagationPrunes += 1
+        return True
+
+    def domain_size(self, var):
+        """
+        Returns the number of values currently left in the domain of |var|.
+        """
+        return len(self.domains[var])
+
+    def in_domain(self, var, val):
+        """
+        Returns whether |val| is still in the domain of |var|.
+        """
+        return val in self.domains[var]
+
+    def get_domain_values(self, var):
+        """
+        Returns the values currently left in the domain of |var|, in domain
+        order.
+        """
+        return self.domains[var]
         
     def get_unassigned_variable(self, assignment):
         """
@@ -187,24 +816,76 @@ class BacktrackingSearch():
         else:
             # Problem 1b
             # Heuristic: most constrained variable (MCV)
-            # Select a variable with the least number of remaining domain values.
-            # Hint: given var, self.domains[var] gives you all the possible values
-            # Hint: get_delta_weight gives the change in weights given a partial
-            #       assignment, a variable, and a proposed value to this variable
-            # BEGIN_YOUR_CODE (around 10 lines of code expected)
-            unassigned = [var for var in self.csp.variables if var not in assignment]
-            minCount = sys.maxint
-            mostConstrained = 0
-            for j in unassigned:
-                countDomain = 0
-                for i in self.domains[j]:
-                    if (self.get_delta_weight(assignment, j, i) != 0):
-                        countDomain = countDomain + 1
-                if countDomain < minCount:
-                    mostConstrained = j
-                    minCount = countDomain
-            return mostConstrained
-            # END_YOUR_CODE
+            # Select a variable with the least number of remaining domain values
+            # that have a non-zero delta weight, the first one in variable order
+            # on ties. Those counts are kept up to date in self.liveCounts as
+            # variables are assigned and values pruned, so the choice is the top
+            # of the heap.
+            return self.mcvHeap.peek()
+
+    def init_live_counts(self):
+        """
+        Set up the bookkeeping behind the MCV heuristic. For every value of
+        every variable, self.deadCounts holds the number of reasons the value
+        currently has a zero delta weight: a zero unary factor, having been
+        pruned from the domain, or a zero binary factor with each assigned
+        neighbor. self.liveCounts[var] is the number of values of |var| with no
+        such reason, and self.mcvHeap orders the unassigned variables by it.
+
+        The counts of a variable are frozen while it is assigned. Assignments
+        and prunes are undone in reverse order, so they are exact again by the
+        time the variable is unassigned.
+        """
+        self.varOrder = {var: i for i, var in enumerate(self.csp.variables)}
+        self.deadCounts = {}
+        self.liveCounts = {}
+        self.mcvHeap = IndexedMinHeap()
+        for var in self.csp.variables:
+            unary = self.csp.unaryFactors[var]
+            dead = {val: int(unary is not None and unary[val] == 0) \
+                for val in self.csp.values[var]}
+            live = sum(1 for val in self.csp.values[var] if dead[val] == 0)
+            self.deadCounts[var] = dead
+            self.liveCounts[var] = live
+            self.mcvHeap.push(var, (live, self.varOrder[var]))
+
+    def update_dead_counts(self, var, vals, delta):
+        """
+        Add |delta| (1 or -1) to the dead counts of the values |vals| of |var|
+        and reposition |var| in the MCV heap if its live count changed.
+
+        @param vals: A list of values.
+        """
+        if var in self.assignment: return
+        dead = self.deadCounts[var]
+        live = self.liveCounts[var]
+        for val in vals:
+            if delta > 0:
+                if dead[val] == 0: live -= 1
+                dead[val] += 1
+            else:
+                dead[val] -= 1
+                if dead[val] == 0: live += 1
+        if live != self.liveCounts[var]:
+            self.liveCounts[var] = live
+            self.mcvHeap.update(var, (live, self.varOrder[var]))
+
+    def count_assignment(self, var, val, delta):
+        """
+        Update the MCV bookkeeping after |var| is assigned |val| (|delta| = 1)
+        or right before that assignment is undone (|delta| = -1): the values
+        of unassigned neighbors with a zero factor against |val| die or revive.
+        """
+        if delta > 0:
+            self.mcvHeap.remove(var)
+        for var2 in self.csp.get_neighbor_vars(var):
+            if var2 in self.assignment: continue
+            factor = self.csp.binaryFactors[var][var2][val]
+            zeros = [val2 for val2 in self.csp.values[var2] if factor[val2] == 0]
+            if not zeros: continue
+            self.update_dead_counts(var2, zeros, delta)
+        if delta < 0:
+            self.mcvHeap.push(var, (self.liveCounts[var], self.varOrder[var]))
 
     def arc_consistency_check(self, var):
         """
@@ -226,21 +907,302 @@ class BacktrackingSearch():
         #   => self.csp.binaryFactors[var1][var2][val1][val2] == 0
         #   (self.csp.binaryFactors[var1][var2] returns a nested dict of all assignments)
 
+        mark = len(self.trail)
+        revisions = self.revise_arc_lists(var)
+        if self.stats is not None:
+            self.stats.ac3Calls += 1
+            self.stats.ac3Revisions += revisions
+            self.stats.ac3Prunes += len(self.trail) - mark
+
+    def revise_arc_lists(self, var):
+        """
+        AC-3 over the value lists of the domains of a CSP. On a compiled CSP,
+        an arc with more than AC3_VECTOR_PAIRS pairs of values left is revised
+        by revise_arc_array(); below that, the NumPy call costs more than the
+        Python loop.
+
+        @param var: The variable whose value has just been set.
+        @return revisions: The number of arcs revised.
+        """
+        revisions = 0
         # BEGIN_YOUR_CODE (around 20 lines of code expected)
-        q = list ()
-        q.append(var)
-        while(len(q) != 0):
-            var1 = q.pop(0)
+        # each variable is queued at most once at a time
+        q = collections.deque([var])
+        queued = set(q)
+        while q:
+            var1 = q.popleft()
+            queued.discard(var1)
+            domain1 = self.domains[var1]
             for var2 in self.csp.get_neighbor_vars(var1):
+                revisions += 1
+                domain2 = self.domains[var2]
+                if self.compiled and len(domain1) * len(domain2) > AC3_VECTOR_PAIRS:
+                    if self.revise_arc_array(var1, var2) and var2 not in queued:
+                        q.append(var2)
+                        queued.add(var2)
+                    continue
+                # factors[val2][val1] is the factor of var1 = val1, var2 = val2
+                factors = self.csp.binaryFactors[var2][var1]
                 changed = False
-                for val2 in self.domains[var2][:]:
-                    matches = False
-                    for val1 in self.domains[var1]:                       
-                        if (self.csp.binaryFactors[var1][var2][val1][val2] != 0):
-                            matches = True
-                    if matches == False:
-                        self.domains[var2].remove(val2)
+                # walk backwards so that the indices recorded on the trail
+                # stay valid while values are deleted
+                for index in xrange(len(domain2) - 1, -1, -1):
+                    val2 = domain2[index]
+                    factor = factors[val2]
+                    for val1 in domain1:
+                        if factor[val1] != 0: break
+                    else:
+                        del domain2[index]
+                        self.trail.append((var2, index, val2))
+                        if self.mcv: self.update_dead_counts(var2, [val2], 1)
                         changed = True
-                if changed: 
+                if changed and var2 not in queued:
                     q.append(var2)
+                    queued.add(var2)
         # END_YOUR_CODE
+        return revisions
+
+    def revise_arc_array(self, var1, var2):
+        """
+        Revise the arc (var1, var2) of a compiled CSP with one lookup in the
+        0/1 support matrix of the pair: the values of var2 that survive are
+        those with support from some value still in the domain of var1.
+
+        @return changed: True if some value was removed.
+        """
+        domain2 = self.domains[var2]
+        supported = self.csp.supports[var1][var2][self.domains[var1]].any(axis=0)[domain2]
+        if supported.all(): return False
+        for index in np.flatnonzero(~supported)[::-1].tolist():
+            val2 = domain2[index]
+            del domain2[index]
+            self.trail.append((var2, index, val2))
+            if self.mcv: self.update_dead_counts(var2, [val2], 1)
+        return True
+
+# State of a worker process of BacktrackingSearch.solve_parallel(), set up once
+# per process by init_subtree_worker().
+subtreeWorker = {}
+
+def init_subtree_worker(csp, options, sharedBest, sharedLock):
+    """
+    Runs in each worker process of solve_parallel() when it starts. The
+    arguments are inherited from the parent process rather than pickled.
+    """
+    subtreeWorker['csp'] = csp
+    subtreeWorker['options'] = options
+    subtreeWorker['sharedBest'] = sharedBest
+    subtreeWorker['sharedLock'] = sharedLock
+
+def search_subtree(subtree):
+    """
+    Runs in a worker process of solve_parallel(): search the subtree below the
+    (prefix, weight) pair |subtree| and return the statistics of that search.
+    """
+    prefix, weight = subtree
+    mcv, ac3, compiled, optimize, maxNodes, timeLimit, startTime, iterative, \
+        keep_all = subtreeWorker['options']
+    search = BacktrackingSearch()
+    search.start_search(subtreeWorker['csp'], mcv, ac3, compiled, optimize, maxNodes, \
+        timeLimit, startTime, subtreeWorker['sharedBest'], subtreeWorker['sharedLock'])
+    for var, val in prefix:
+        search.assign_value(var, val)  # consistent, as checked by split_subtrees()
+    if iterative:
+        solutions = search.backtrack_iterative(search.assignment, len(prefix), weight)
+    else:
+        solutions = search.backtrack(search.assignment, len(prefix), weight)
+    for assignment in solutions:
+        if keep_all:
+            search.allAssignments.append(assignment)
+    return get_search_result(search)
+
+def get_search_result(search):
+    """
+    Returns the statistics of the finished |search|, as a dictionary that can
+    be sent back from a worker process.
+    """
+    return {'optimalAssignment': search.optimalAssignment,
+        'optimalWeight': search.optimalWeight,
+        'numOptimalAssignments': search.numOptimalAssignments,
+        'numAssignments': search.numAssignments,
+        'numOperations': search.numOperations,
+        'firstAssignmentNumOperations': search.firstAssignmentNumOperations,
+        'allAssignments': search.allAssignments,
+        'budgetExhausted': search.budgetExhausted}
+
+def search_csp(csp, options):
+    """
+    Searches |csp| from the root with the |options| of solve_decomposed() and
+    returns the statistics of that search (see get_search_result()).
+    """
+    mcv, ac3, compiled, optimize, maxNodes, timeLimit, startTime, iterative, \
+        keep_all = options
+    search = BacktrackingSearch()
+    search.start_search(csp, mcv, ac3, compiled, optimize, maxNodes, timeLimit, startTime)
+    if search.rootConsistent:
+        if iterative:
+            solutions = search.backtrack_iterative(search.assignment, 0, 1)
+        else:
+            solutions = search.backtrack(search.assignment, 0, 1)
+        for assignment in solutions:
+            if keep_all:
+                search.allAssignments.append(assignment)
+    return get_search_result(search)
+
+def solve_tree(csp, component):
+    """
+    Solves exactly the connected |component| of |csp|, a tree of binary
+    factors (see CSP.is_tree()), by max-product dynamic programming. With the
+    tree rooted at its first variable, each variable sends its parent, for
+    every value of the parent, the best weight of its subtree; the best values
+    are then read from the root down. The optimal and the consistent (nonzero
+    weight) assignments are counted along the way, in exact integers.
+
+    @return result: The statistics of the component, as returned by
+        get_search_result(), with no call to backtrack().
+    """
+    root = component[0]
+    parent = {root: None}
+    order = [root]
+    for var in order:
+        for neighbor in csp.binaryFactors[var]:
+            if neighbor not in parent:
+                parent[neighbor] = var
+                order.append(neighbor)
+    # For each value a of var, over the subtree of var with var = a: best[var][a]
+    # is the best weight, numBest[var][a] the number of assignments reaching
+    # it and total[var][a] the number of consistent assignments.
+    best, numBest, total = {}, {}, {}
+    for var in order:
+        factor = csp.unaryFactorArrays[var]
+        best[var] = np.ones(len(csp.values[var])) if factor is None else factor.copy()
+        numBest[var] = (best[var] > 0).astype(object)
+        total[var] = numBest[var].copy()
+    for var in reversed(order[1:]):
+        factor = csp.binaryFactorArrays[parent[var]][var]
+        weights = factor * best[var]
+        rowBest = weights.max(axis = 1)
+        # the same weight can be reached by multiplying in another order
+        isBest = (weights > 0) & (weights >= rowBest[:, np.newaxis] * (1 - 1e-9))
+        best[parent[var]] *= rowBest
+        numBest[parent[var]] *= (isBest.astype(object) * numBest[var]).sum(axis = 1)
+        total[parent[var]] *= ((factor > 0).astype(object) * total[var]).sum(axis = 1)
+
+    result = {'optimalAssignment': {}, 'optimalWeight': 0, 'numOptimalAssignments': 0,
+        'numAssignments': int(total[root].sum()), 'numOperations': 0,
+        'firstAssignmentNumOperations': 0, 'allAssignments': [], 'budgetExhausted': False}
+    optimalWeight = best[root].max()
+    if optimalWeight <= 0: return result
+    isBest = best[root] >= optimalWeight * (1 - 1e-9)
+    choice = {root: int(np.argmax(best[root]))}
+    for var in order[1:]:
+        weights = csp.binaryFactorArrays[parent[var]][var][choice[parent[var]]] * best[var]
+        choice[var] = int(np.argmax(weights))
+    result['optimalAssignment'] = {var: csp.values[var][choice[var]] for var in component}
+    result['optimalWeight'] = float(optimalWeight)
+    result['numOptimalAssignments'] = int(numBest[root][isBest].sum())
+    return result
+
+# State of a worker process of BacktrackingSearch.solve_decomposed(), set up
+# once per process by init_component_worker().
+componentWorker = {}
+
+def init_component_worker(csps, options):
+    """
+    Runs in each worker process of solve_decomposed() when it starts. The
+    arguments are inherited from the parent process rather than pickled.
+    """
+    componentWorker['csps'] = csps
+    componentWorker['options'] = options
+
+def search_component(index):
+    """
+    Runs in a worker process of solve_decomposed(): search the component CSP
+    at |index| and return the statistics of that search.
+    """
+    return search_csp(componentWorker['csps'][index], componentWorker['options'])
+
+# A binary min-heap whose items can be moved or removed in O(log n), by
+# keeping track of the position of every item in the heap.
+class IndexedMinHeap():
+    def __init__(self):
+        # List of [key, item] entries in heap order.
+        self.heap = []
+        # Dictionary from item to the index of its entry in self.heap.
+        self.position = {}
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, item):
+        return item in self.position
+
+    def peek(self):
+        """
+        Returns the item with the smallest key.
+        """
+        return self.heap[0][1]
+
+    def push(self, item, key):
+        """
+        Adds |item|, which must not be in the heap yet, with priority |key|.
+        """
+        self.heap.append([key, item])
+        self.position[item] = len(self.heap) - 1
+        self.sift_up(len(self.heap) - 1)
+
+    def update(self, item, key):
+        """
+        Changes the priority of |item| to |key|, if it is in the heap.
+        """
+        if item not in self.position: return
+        i = self.position[item]
+        oldKey = self.heap[i][0]
+        self.heap[i][0] = key
+        if key < oldKey:
+            self.sift_up(i)
+        else:
+            self.sift_down(i)
+
+    def remove(self, item):
+        """
+        Removes |item| from the heap.
+        """
+        i = self.position.pop(item)
+        last = self.heap.pop()
+        if i == len(self.heap): return
+        oldKey = self.heap[i][0]
+        self.heap[i] = last
+        self.position[last[1]] = i
+        if last[0] < oldKey:
+            self.sift_up(i)
+        else:
+            self.sift_down(i)
+
+    def sift_up(self, i):
+        heap = self.heap
+        entry = heap[i]
+        while i > 0:
+            parent = (i - 1) >> 1
+            if not entry[0] < heap[parent][0]: break
+            heap[i] = heap[parent]
+            self.position[heap[i][1]] = i
+            i = parent
+        heap[i] = entry
+        self.position[entry[1]] = i
+
+    def sift_down(self, i):
+        heap = self.heap
+        entry = heap[i]
+        n = len(heap)
+        while True:
+            child = 2 * i + 1
+            if child >= n: break
+            if child + 1 < n and heap[child + 1][0] < heap[child][0]:
+                child += 1
+            if not heap[child][0] < entry[0]: break
+            heap[i] = heap[child]
+            self.position[heap[i][1]] = i
+            i = child
+        heap[i] = entry
+        self.position[entry[1]] = i
@@ -0,0 +1,201 @@
+import argparse, json, multiprocessing, os, signal, sys, time
+import algorithms
+import csp
+import plannerReqs
+import solverStats
+import util
+
+# Batch entry point of the meal planner: plans every family profile given on
+# the command line (profile files or directories of them) or, with '-', read
+# as paths from standard input, and writes one JSON line per profile:
+#   python batchPlanner.py profiles/ --timeout 10 --output plans.jsonl
+# The recipe book is loaded once in the main process and shared with the
+# worker processes, which each plan one profile at a time. Throughput and
+# latency statistics are printed to standard error at the end.
+
+# Solver options of every job: the same as grader.py.
+SOLVE_OPTIONS = {'mcv': True, 'ac3': True, 'optimize': True}
+
+# Extra seconds given to a job after its search time limit before it is
+# interrupted, e.g. while the CSP is still being built.
+GRACE_SECONDS = 5.0
+
+class JobTimeout(Exception):
+    pass
+
+# State of a worker process, set by init_plan_worker(): the shared
+# RecipeData, the time limit of a job and whether to report solver stats.
+planWorker = {}
+
+def init_plan_worker(recipeData, timeout, withStats):
+    planWorker['recipeData'] = recipeData
+    planWorker['timeout'] = timeout
+    planWorker['withStats'] = withStats
+    # Ctrl-C is handled by the main process, which terminates the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def raise_job_timeout(signum, frame):
+    raise JobTimeout()
+
+def plan_profile(prefsPath, recipeData, timeout = None, withStats = False, search = None):
+    """
+    Plans the meals of the profile file |prefsPath| with the recipes of
+    |recipeData|.
+
+    @param timeout: Seconds after which the search stops and keeps the best
+        plan found so far, or None.
+    @param withStats: If True, the result also holds the solver statistics
+        (see solverStats.SolverStats.to_json()).
+    @param search: The BacktrackingSearch to plan with, by default a new one.
+        Its counters are kept up to date if the planning is interrupted.
+    @return result: A dict with the profile path, the status ('optimal',
+        'timeout' if the plan is the best found within |timeout|, or
+        'infeasible'), the weight and the plan as a list of {meal, rid, name},
+        the number of operations of the search and the seconds it took.
+    """
+    stats = solverStats.SolverStats() if withStats else None
+    start = time.time()
+    profile = plannerReqs.Profile(prefsPath)
+    profile.setRecipeBook(plannerReqs.RecipeBook(recipeData, profile))
+    stdout = sys.stdout
+    # the constructor and the solver report their progress on stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        mealCSP = csp.MealPlanCSPConstructor(profile.recipeBook, profile).get_basic_csp(stats)
+        if search is None: search = algorithms.BacktrackingSearch()
+        search.solve(mealCSP, timeLimit = timeout, stats = stats, **SOLVE_OPTIONS)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    if search.optimalAssignment:
+        status = 'timeout' if search.budgetExhausted else 'optimal'
+        plan = [{'meal': meal, 'rid': recipe.rid, 'name': recipe.getName()} \
+            for recipe, meal in util.extract_meal_plan_solution(profile, search.optimalAssignment)]
+    else:
+        status = 'timeout' if search.budgetExhausted else 'infeasible'
+        plan = None
+    result = {'profile': prefsPath, 'status': status, 'weight': search.optimalWeight, \
+        'plan': plan, 'operations': search.numOperations, 'seconds': time.time() - start}
+    if stats is not None:
+        result['stats'] = stats.to_json()
+    return result
+
+def run_plan_job(prefsPath):
+    """
+    Runs in a worker process: plans |prefsPath| and never raises, so that one
+    bad profile does not stop the batch. The job is interrupted GRACE_SECONDS
+    after its time limit. The result of an interrupted or failed job has the
+    same keys as the others, with the operations of the search so far.
+    """
+    start = time.time()
+    search = algorithms.BacktrackingSearch()
+    # the counters read below if the job does not finish
+    search.reset_results()
+    timeout = planWorker['timeout']
+    if timeout is not None:
+        signal.signal(signal.SIGALRM, raise_job_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout + GRACE_SECONDS)
+    try:
+        return plan_profile(prefsPath, planWorker['recipeData'], timeout, \
+            planWorker['withStats'], search)
+    except JobTimeout:
+        result = {'profile': prefsPath, 'status': 'timeout'}
+    except Exception as e:
+        result = {'profile': prefsPath, 'status': 'error', 'error': '%s: %s' % \
+            (type(e).__name__, e)}
+    finally:
+        if timeout is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    result.update(weight = 0, plan = None, operations = search.numOperations, \
+        seconds = time.time() - start)
+    if planWorker['withStats']:
+        result['stats'] = None
+    return result
+
+def iter_profile_paths(sources, stdin = sys.stdin):
+    """
+    Yields the profile files of |sources|: each is a profile file, a
+    directory whose files (sorted by name) are profiles, or '-' to read one
+    path per line from |stdin| as they arrive.
+    """
+    for source in sources:
+        if source == '-':
+            for line in iter(stdin.readline, ''):
+                if line.strip(): yield line.strip()
+        elif os.path.isdir(source):
+            for name in sorted(os.listdir(source)):
+                path = os.path.join(source, name)
+                if os.path.isfile(path) and not name.startswith('.'):
+                    yield path
+        else:
+            yield source
+
+def percentile(sortedValues, fraction):
+    """
+    Returns the value at |fraction| (between 0 and 1) of the non-empty sorted
+    list |sortedValues|, by the nearest-rank method.
+    """
+    rank = max(int(round(fraction * len(sortedValues) + 0.5)) - 1, 0)
+    return sortedValues[min(rank, len(sortedValues) - 1)]
+
+def print_batch_stats(results, seconds, output = sys.stderr):
+    """
+    Prints the number of jobs by status, the throughput and the latency
+    distribution of the |results| of a batch that took |seconds|.
+    """
+    statuses = {}
+    for result in results:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+    print >>output, "Planned %d profiles in %.2f s (%.2f profiles/s): %s" % (len(results), \
+        seconds, len(results) / seconds if seconds > 0 else 0, \
+        ', '.join('%d %s' % (count, status) for status, count in sorted(statuses.items())))
+    if results:
+        latencies = sorted(result['seconds'] for result in results)
+        print >>output, "Latency (s): mean %.3f, p50 %.3f, p90 %.3f, p99 %.3f, max %.3f" % \
+            (sum(latencies) / len(latencies), percentile(latencies, 0.5), \
+            percentile(latencies, 0.9), percentile(latencies, 0.99), latencies[-1])
+
+def run_batch(recipesPath, sources, output = sys.stdout, processes = None, timeout = None, \
+        withStats = False):
+    """
+    Plans every profile of |sources| (see iter_profile_paths()) on a pool of
+    |processes| worker processes (by default one per CPU) and writes each
+    result to |output| as a JSON line, in order of completion. With
+    |withStats|, each result holds the solver statistics of its profile.
+
+    @return results: The list of the result dicts (see plan_profile()).
+    """
+    recipeData = plannerReqs.load_recipe_data(recipesPath)
+    start = time.time()
+    results = []
+    # The workers are forked after the recipe data is loaded, so they share
+    # its memory-mapped pages instead of each loading the book.
+    pool = multiprocessing.Pool(processes, init_plan_worker, (recipeData, timeout, withStats))
+    try:
+        for result in pool.imap_unordered(run_plan_job, iter_profile_paths(sources)):
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            results.append(result)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    print_batch_stats(results, time.time() - start)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Plan the meals of many family profiles.')
+    parser.add_argument('sources', nargs = '+', \
+        help = "profile files, directories of profile files, or '-' to read paths from stdin")
+    parser.add_argument('--recipes', default = 'recipeData.txt', help = 'recipe file')
+    parser.add_argument('--output', help = 'JSON lines output file (default: stdout)')
+    parser.add_argument('--processes', type = int, help = 'worker processes (default: CPUs)')
+    parser.add_argument('--timeout', type = float, help = 'search time limit per profile (s)')
+    parser.add_argument('--stats', action = 'store_true', \
+        help = 'include the solver statistics of every profile')
+    args = parser.parse_args()
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        run_batch(args.recipes, args.sources, output, args.processes, args.timeout, args.stats)
+    finally:
+        if args.output: output.close()
@@ -0,0 +1,599 @@
+import argparse, fractions, json, os, random, shutil, sys, tempfile, time, StringIO
+import numpy as np
+import csp
+import algorithms
+import plannerReqs
+import recipeCache
+
+# Benchmarks for the meal plan CSP solver. Run from the mealplan directory:
+#   python benchmark.py [engines] [bounds] [compiled] [parallel]
+#       [decomposition] [eligibility] [encodings] [pipeline]
+# Without arguments all but the pipeline benchmark are run.
+# The pipeline benchmark times the planner end to end on synthetic books and
+# profiles of increasing size and compares the results with a saved
+# baseline:
+#   python benchmark.py pipeline --save-baseline
+#   python benchmark.py pipeline
+
+# Default file of the pipeline baseline, next to this module.
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarkBaseline.json')
+
+# Scenarios of the pipeline benchmark, from the size of recipeData.txt up:
+# (name, recipes in the book, meals, pantry ingredients, calorie budget as a
+# fraction of the average calories of the meals). The books grow faster than
+# the CSPs: the pantries of the larger books are smaller, so that every CSP
+# keeps a few thousand variables at most, and the profiles have few meals, so
+# that the search reaches a first plan within its node budget (with many
+# meals, the first plans take many more nodes than there are variables).
+# The last scenario is the exception: two weeks of meals on a calorie budget
+# of about the average, whose solves run out of budget before a first plan
+# and track how fast the search gets there.
+PIPELINE_SCENARIOS = [
+    ('small', 500, 3, 40, 1.5),
+    ('medium', 2000, 3, 50, 1.5),
+    ('large', 8000, 3, 30, 1.5),
+    ('xlarge', 32000, 4, 15, 1.5),
+    ('tight', 1000, 14, 40, 1.0)]
+
+# Node budget of each pipeline solve per variable of its CSP. A search needs
+# at least as many nodes as there are variables to reach a plan.
+NODES_PER_VARIABLE = 4
+
+# Heuristic combinations under which each pipeline scenario is solved.
+HEURISTICS = [('plain', {}), ('mcv', {'mcv': True}), ('ac3', {'ac3': True}),
+    ('mcv+ac3', {'mcv': True, 'ac3': True})]
+
+def random_csp(numVars, domainSize, density, seed = 0):
+    """
+    Returns a random weighted CSP with |numVars| variables of |domainSize|
+    values each. Every variable gets random unary weights and every pair of
+    variables is constrained with probability |density| by a random 0/1
+    binary factor.
+    """
+    rnd = random.Random(seed)
+    randomCSP = csp.CSP()
+    for i in range(numVars):
+        weights = [rnd.choice([0.0, 1.0, 2.0, 3.0]) for val in range(domainSize)]
+        randomCSP.add_variable(i, range(domainSize))
+        randomCSP.add_unary_factor(i, lambda val: weights[val])
+    for i in range(numVars):
+        for j in range(i + 1, numVars):
+            if rnd.random() < density:
+                allowed = set((a, b) for a in range(domainSize) for b in range(domainSize) \
+                    if rnd.random() < 0.8)
+                randomCSP.add_binary_factor(i, j, lambda a, b: (a, b) in allowed)
+    return randomCSP
+
+def chain_csp(numVars):
+    """
+    Returns a CSP of |numVars| boolean variables chained by "not both True"
+    constraints. Reaching any of its solutions takes |numVars| nested calls
+    to backtrack().
+    """
+    chainCSP = csp.CSP()
+    for i in range(numVars):
+        chainCSP.add_variable(i, [True, False])
+        if i > 0:
+            chainCSP.add_binary_factor(i - 1, i, lambda a, b: not (a and b))
+    return chainCSP
+
+def rated_csp(numChoices, numRated, seed = 0):
+    """
+    Returns a CSP of |numChoices| boolean variables of which at most one is
+    True, weighing about 20 when True (the first ones the most), followed by
+    |numRated| independent boolean variables weighing a random rating between
+    1 and 5 when True, like the (recipe, meal) variables of a meal plan. The
+    product of the largest factors of all the variables, which bounds the
+    weight at the root, overflows a float beyond about 240 choices, although
+    the optimal weight does not.
+    """
+    rnd = random.Random(seed)
+    ratedCSP = csp.CSP()
+    for i in range(numChoices):
+        weight = 20.0 - 0.01 * i
+        ratedCSP.add_variable(('choice', i), [True, False])
+        ratedCSP.add_unary_factor(('choice', i), lambda taken: weight if taken else 1.0)
+    ratedCSP.add_at_most_one_constraint([('choice', i) for i in range(numChoices)], [True])
+    for i in range(numRated):
+        rating = rnd.uniform(1, 5)
+        ratedCSP.add_variable(('rated', i), [True, False])
+        ratedCSP.add_unary_factor(('rated', i), lambda taken: rating if taken else 1.0)
+    return ratedCSP
+
+def write_synthetic_recipes(recipesPath, numRecipes, numIngredients, seed = 0):
+    """
+    Writes a recipe file in the format of recipeData.txt with |numRecipes|
+    random recipes of 3 to 12 ingredients each, drawn from |numIngredients|
+    ingredients with a skewed popularity like real recipes.
+    """
+    rnd = random.Random(seed)
+    with open(recipesPath, 'wb') as recipes:
+        for rid in xrange(numRecipes):
+            ingredients = set()
+            for i in range(rnd.randint(3, 12)):
+                ingredients.add(int(numIngredients * rnd.random() ** 3))
+            ingredString = ','.join('ingredient%d;%d' % (ingred, rnd.randint(1, 4)) \
+                for ingred in sorted(ingredients))
+            recipes.write('%d<>Recipe %d<>%d<>%d<>%.2f<>%d<>%s<>Bake it.\n' % (rid, rid, \
+                rnd.randint(5, 180), rnd.randint(50, 900), rnd.uniform(1, 5), \
+                rnd.randint(0, 1000), ingredString))
+
+def format_quantity(quantity):
+    """
+    Returns |quantity| written as in the recipe files, such as '2', '1/4' or
+    '1 1/2'.
+    """
+    quantity = fractions.Fraction(quantity).limit_denominator(16)
+    whole, part = divmod(quantity, 1)
+    if not part: return '%d' % whole
+    if not whole: return '%d/%d' % (part.numerator, part.denominator)
+    return '%d %d/%d' % (whole, part.numerator, part.denominator)
+
+def write_sampled_recipes(recipesPath, numRecipes, data, seed = 0):
+    """
+    Writes a recipe file of |numRecipes| recipes resembling those of the
+    RecipeData |data|: each one copies the instructions, rating and number of
+    ingredients of a random recipe of |data|, with its cooking time and
+    calories jittered by up to 25%, and a third of its ingredients replaced by
+    ingredients drawn by their popularity in |data|, with one of their
+    quantities in |data|.
+    """
+    rnd = random.Random(seed)
+    byIngredient = data.recipesByIngredient
+    popularity = np.cumsum(np.diff(byIngredient.indptr)).tolist()
+    def random_ingredient():
+        col = np.searchsorted(popularity, rnd.random() * popularity[-1], side='right')
+        qty = byIngredient.data[rnd.randrange(byIngredient.indptr[col], byIngredient.indptr[col + 1])]
+        return data.ingredientNames[col], qty
+    with open(recipesPath, 'wb') as recipes:
+        for rid in xrange(numRecipes):
+            row = rnd.randrange(len(data))
+            ingredients = {}
+            for ingred, qty in zip(data.get_ingredients(row), \
+                    data.quantities.data[data.quantities.indptr[row]:data.quantities.indptr[row + 1]]):
+                if rnd.random() < 1.0 / 3: ingred, qty = random_ingredient()
+                ingredients[ingred] = qty
+            ingredString = ','.join('%s;%s' % (ingred, format_quantity(qty)) \
+                for ingred, qty in sorted(ingredients.iteritems()))
+            recipes.write('%d<>%s %d<>%d<>%d<>%.2f<>%d<>%s<>%s\n' % (rid, data.names[row], rid, \
+                max(1, int(data.cookingTimes[row] * rnd.uniform(0.75, 1.25))), \
+                max(1, int(data.calorieCounts[row] * rnd.uniform(0.75, 1.25))), \
+                data.ratings[row], data.reviewCounts[row], ingredString, data.instructions[row].rstrip('\n')))
+
+def write_synthetic_profile(prefsPath, data, numMeals, pantrySize, calorieFactor, seed = 0):
+    """
+    Writes a family profile for the recipes of the RecipeData |data|, in the
+    format of exampleFamilyPref.txt: |numMeals| lunches and dinners, a third
+    of them hot, with cooking time limits drawn from the cooking times of
+    |data|, a calorie budget of |calorieFactor| times the average calories
+    of the meals, and a pantry of the |pantrySize| most used ingredients, a
+    quarter of them in limited quantities and some with a shelf life.
+    """
+    rnd = random.Random(seed)
+    cookingTimes = sorted(data.cookingTimes.tolist())
+    budget = int(calorieFactor * numMeals * data.calorieCounts.mean())
+    pantry = np.argsort(-np.diff(data.recipesByIngredient.indptr), kind='mergesort')[:pantrySize]
+    with open(prefsPath, 'wb') as prefs:
+        prefs.write('%d\n' % budget)
+        for i in range(numMeals):
+            # meals are named like those of exampleFamilyPref.txt, two a day
+            meal = '%s%d-%d' % ('LD'[i % 2], 11 + i / 62, 11 + i / 2 % 31)
+            maxTime = max(cookingTimes[rnd.randrange(len(cookingTimes) / 4, len(cookingTimes))], 20)
+            prefs.write('%s %d%s\n' % (meal, maxTime, ' hot' if rnd.random() < 1.0 / 3 else ''))
+        prefs.write('---\n')
+        for col in pantry:
+            quantity = format_quantity(rnd.randint(2, 20)) if rnd.random() < 0.25 else ''
+            shelfLife = ';%d' % rnd.randint(1, 30) if rnd.random() < 0.1 else ''
+            if quantity or shelfLife:
+                prefs.write('%s:%s%s\n' % (data.ingredientNames[col], quantity, shelfLife))
+            else:
+                prefs.write('%s\n' % data.ingredientNames[col])
+        prefs.write('---\n')
+
+def time_quietly(function, *args, **kwargs):
+    """
+    Calls |function| with its output on stdout discarded.
+
+    @return (seconds, result): The wall time of the call and its result.
+    """
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    start = time.time()
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        sys.stdout = stdout
+    return time.time() - start, result
+
+def time_solve(problem, parallel = False, **options):
+    """
+    Solves |problem| with BacktrackingSearch and the given solve() options,
+    or with solve_parallel() if |parallel| is set.
+
+    @return (seconds, search): The wall time of the solve, or None if it failed
+        with a RuntimeError (e.g. maximum recursion depth exceeded), and the
+        search object with its statistics.
+    """
+    search = algorithms.BacktrackingSearch()
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    start = time.time()
+    try:
+        if parallel:
+            search.solve_parallel(problem, **options)
+        else:
+            search.solve(problem, **options)
+        seconds = time.time() - start
+    except RuntimeError:
+        seconds = None
+    finally:
+        sys.stdout = stdout
+    return seconds, search
+
+def benchmark_engines():
+    """
+    Compares the recursive and the explicit-stack (iterative) backtracking
+    engines on random CSPs and on chains deeper than the recursion limit.
+    """
+    problems = [('random 14x4', random_csp(14, 4, 0.3)),
+        ('random 16x3', random_csp(16, 3, 0.2, seed = 2)),
+        ('chain 500', chain_csp(500)),
+        ('chain 5000', chain_csp(5000))]
+    print "%-14s %-9s %-10s %12s %12s" % ("CSP", "options", "engine", "seconds", "operations")
+    for name, problem in problems:
+        for options in [{}, {'mcv': True, 'ac3': True}]:
+            label = 'mcv+ac3' if options else 'plain'
+            if name.startswith('chain'):
+                # the first solution is all that is needed to reach full depth
+                options = dict(options, maxNodes = 2 * problem.numVars)
+            for engine in ['recursive', 'iterative']:
+                seconds, search = time_solve(problem, iterative = engine == 'iterative', \
+                    **options)
+                if seconds is None:
+                    print "%-14s %-9s %-10s %12s %12s" % (name, label, engine, "too deep", "-")
+                else:
+                    print "%-14s %-9s %-10s %12.3f %12d" % (name, label, engine, seconds, \
+                        search.numOperations)
+
+def load_meal_plan_csp(recipesPath, prefsPath, useGlobalConstraints = True):
+    """
+    Returns the meal plan CSP of the profile |prefsPath| over the recipes of
+    |recipesPath|.
+    """
+    data = recipeCache.load_recipes(recipesPath)
+    profile = plannerReqs.Profile(prefsPath)
+    book = plannerReqs.RecipeBook(data, profile)
+    profile.setRecipeBook(book)
+    constructor = csp.MealPlanCSPConstructor(book, profile, useGlobalConstraints)
+    return time_quietly(constructor.get_basic_csp)[1]
+
+def benchmark_bounds(sizes = [(100, 100), (300, 200)]):
+    """
+    Checks that the weight bound of optimize mode still prunes on CSPs of
+    hundreds of variables whose bound at the root overflows a float (see
+    rated_csp()). The first solution is the optimum, so once the choice is
+    made the rated variables must be pruned right away: the search takes
+    about one node per choice variable below each choice, whereas without
+    pruning it would not end.
+    """
+    print "%-14s %12s %12s %12s %12s" % ("CSP", "variables", "seconds", "operations", \
+        "log weight")
+    for numChoices, numRated in sizes:
+        problem = rated_csp(numChoices, numRated)
+        seconds, search = time_solve(problem, optimize = True, iterative = True, \
+            maxNodes = numChoices ** 2 + 10 * numRated)
+        assert not search.budgetExhausted, "the bound did not prune on %d variables" % \
+            problem.numVars
+        print "%-14s %12d %12.3f %12d %12.2f" % ('rated %dx%d' % (numChoices, numRated), \
+            problem.numVars, seconds, search.numOperations, np.log(search.optimalWeight))
+
+def benchmark_compiled(recipesPath = 'recipeData.txt', maxNodes = 5000):
+    """
+    Compares the search on a CSP and on its compiled form (solve(compiled =
+    True)) under each of HEURISTICS. On random CSPs, whose small integer
+    values are as cheap to look up in dictionaries as in lists, all the
+    solutions are searched. On meal plan CSPs, whose variables are (recipe,
+    meal) pairs, the search optimizes for |maxNodes| nodes: the auxiliary
+    encoding of the example profile, and the pipeline scenarios 'small' and
+    'medium' (see benchmark_pipeline()). Both searches visit the same nodes.
+    Each CSP is compiled once, which is timed separately.
+    """
+    workDir = tempfile.mkdtemp()
+    try:
+        source = recipeCache.load_recipes(recipesPath)
+        problems = [('random 12x4', random_csp(12, 4, 0.3), {}),
+            ('random 16x3', random_csp(16, 3, 0.2, seed = 2), {}),
+            ('example aux', load_meal_plan_csp(recipesPath, 'exampleFamilyPref.txt', False), \
+                {'optimize': True, 'maxNodes': maxNodes})]
+        for seed, (name, numRecipes, numMeals, pantrySize, calorieFactor) in \
+                enumerate(PIPELINE_SCENARIOS[:2]):
+            bookPath = os.path.join(workDir, '%s.txt' % name)
+            prefsPath = os.path.join(workDir, '%s.pref' % name)
+            write_sampled_recipes(bookPath, numRecipes, source, seed)
+            write_synthetic_profile(prefsPath, source, numMeals, pantrySize, calorieFactor, seed)
+            problems.append(('pipeline ' + name, load_meal_plan_csp(bookPath, prefsPath), \
+                {'optimize': True, 'maxNodes': maxNodes}))
+        print "%-16s %-9s %10s %10s %8s %12s" % ("CSP", "options", "dict (s)", "compiled", \
+            "speedup", "operations")
+        for name, problem, options in problems:
+            compileSeconds, compiledProblem = time_quietly(problem.compile)
+            print "%-16s %-9s %10s %10.3f %8s %12s" % (name, 'compile', '-', compileSeconds, '-', '-')
+            for label, heuristics in HEURISTICS:
+                heuristics = dict(options, iterative = True, **heuristics)
+                seconds, search = time_solve(problem, **heuristics)
+                compiledSeconds, compiledSearch = time_solve(compiledProblem, compiled = True, \
+                    **heuristics)
+                assert (search.numOperations, search.optimalWeight) == \
+                    (compiledSearch.numOperations, compiledSearch.optimalWeight)
+                print "%-16s %-9s %10.3f %10.3f %7.2fx %12d" % (name, label, seconds, \
+                    compiledSeconds, seconds / compiledSeconds, search.numOperations)
+    finally:
+        shutil.rmtree(workDir)
+
+def benchmark_parallel(processes = None):
+    """
+    Compares solve() and solve_parallel() searching all the solutions of
+    random CSPs.
+    """
+    problems = [('random 14x4', random_csp(14, 4, 0.3)),
+        ('random 16x3', random_csp(16, 3, 0.2, seed = 2))]
+    print "%-14s %-10s %12s %12s %12s" % ("CSP", "solver", "seconds", "operations", "weight")
+    for name, problem in problems:
+        for parallel in [False, True]:
+            options = {'mcv': True, 'ac3': True}
+            if parallel: options['processes'] = processes
+            seconds, search = time_solve(problem, parallel, **options)
+            print "%-14s %-10s %12.3f %12d %12g" % (name, 'parallel' if parallel else 'serial', \
+                seconds, search.numOperations, search.optimalWeight)
+
+def benchmark_decomposition():
+    """
+    Compares solve() and solve_decomposed() on sparse random CSPs, whose
+    constraint graphs fall apart into components, many of them trees, and on
+    a chain, which is one tree.
+    """
+    problems = [('random 20x3', random_csp(20, 3, 0.1, seed = 6), {'optimize': True}),
+        ('random 24x3', random_csp(24, 3, 0.06, seed = 3), {'optimize': True}),
+        ('chain 24', chain_csp(24), {})]
+    print "%-14s %-12s %12s %12s %12s %12s" % ("CSP", "solver", "seconds", "operations", \
+        "weight", "optimal")
+    for name, problem, options in problems:
+        options = dict(options, mcv = True, ac3 = True, iterative = True)
+        for solver in ['solve', 'solve_decomposed']:
+            search = algorithms.BacktrackingSearch()
+            seconds, _ = time_quietly(getattr(search, solver), problem, **options)
+            print "%-14s %-12s %12.3f %12d %12g %12d" % (name, solver.replace('solve_', ''), \
+                seconds, search.numOperations, search.optimalWeight, search.numOptimalAssignments)
+
+def benchmark_eligibility(numRecipes = 100000, numIngredients = 2000, pantrySize = 150):
+    """
+    Compares the per-recipe loop that RecipeBook used to filter the recipes of
+    a pantry with the queries of the inverted ingredient index, on a synthetic
+    recipe book.
+    """
+    workDir = tempfile.mkdtemp()
+    try:
+        recipesPath = os.path.join(workDir, 'recipes.txt')
+        write_synthetic_recipes(recipesPath, numRecipes, numIngredients)
+        data = recipeCache.load_recipes(recipesPath)
+        rnd = random.Random(1)
+        # the pantry holds mostly the popular ingredients, which most recipes use
+        pantry = dict(('ingredient%d' % ingred, rnd.randint(1, 4)) \
+            for ingred in rnd.sample(range(numIngredients / 4), pantrySize))
+        recipes = [dict(zip(data.get_ingredients(row), \
+            data.quantities.data[data.quantities.indptr[row]:data.quantities.indptr[row + 1]])) \
+            for row in xrange(len(data))]
+
+        def loop():
+            return [row for row, ingredients in enumerate(recipes) \
+                if all(ingred in pantry and qty <= pantry[ingred] for ingred, qty in ingredients.iteritems())]
+        def loop_missing_one():
+            return [row for row, ingredients in enumerate(recipes) \
+                if sum(ingred not in pantry or qty > pantry[ingred] \
+                    for ingred, qty in ingredients.iteritems()) <= 1]
+        def loop_using():
+            return [row for row, ingredients in enumerate(recipes) if 'ingredient7' in ingredients]
+        queries = [('cookable', loop, lambda: data.find_cookable(pantry)),
+            ('missing <= 1', loop_missing_one, lambda: data.find_cookable(pantry, 1)),
+            ('using one', loop_using, lambda: data.get_recipes_using('ingredient7'))]
+        print "%d recipes, %d ingredients, pantry of %d" % (numRecipes, numIngredients, pantrySize)
+        print "%-14s %12s %12s %12s" % ("query", "loop (s)", "index (s)", "recipes")
+        for name, slow, fast in queries:
+            start = time.time()
+            expected = slow()
+            loopSeconds = time.time() - start
+            start = time.time()
+            rows = fast()
+            indexSeconds = time.time() - start
+            assert list(rows) == expected
+            print "%-14s %12.4f %12.4f %12d" % (name, loopSeconds, indexSeconds, len(rows))
+    finally:
+        shutil.rmtree(workDir)
+
+def write_short_lived_profile(prefsPath, shortPrefsPath):
+    """
+    Writes to |shortPrefsPath| the profile |prefsPath| with a shelf life of 1
+    for every pantry ingredient, so that no recipe is left for any meal but
+    the first and no plan exists.
+    """
+    with open(prefsPath, 'rb') as prefs:
+        lines = prefs.read().splitlines()
+    pantry = lines.index('---') + 1
+    with open(shortPrefsPath, 'wb') as shortPrefs:
+        for i, line in enumerate(lines):
+            if i >= pantry and line != '---':
+                line = '%s:%s;1' % (line.split(':')[0], line.partition(':')[2].split(';')[0])
+            shortPrefs.write(line + '\n')
+
+def benchmark_encodings(recipesPath = 'recipeData.txt', prefsPath = 'exampleFamilyPref.txt'):
+    """
+    Compares the four encodings of the meal plan CSP (see
+    MealPlanCSPConstructor): the native global constraints or the auxiliary
+    variables of util.get_sum_variable() and util.get_or_variable(), each
+    with and without presolve(). They are solved to optimality on the
+    example profile, and on a variant of it without any plan (see
+    write_short_lived_profile()), and must agree on the optimal weight and
+    the number of optimal plans.
+    """
+    data = plannerReqs.load_recipe_data(recipesPath)
+    workDir = tempfile.mkdtemp()
+    try:
+        shortPrefsPath = os.path.join(workDir, 'shortLived.pref')
+        write_short_lived_profile(prefsPath, shortPrefsPath)
+        print "%-12s %-10s %-8s %10s %10s %12s %12s %12s" % ("profile", "encoding", \
+            "presolve", "variables", "construct", "solve (s)", "weight", "optimal")
+        for name, path in [('example', prefsPath), ('short-lived', shortPrefsPath)]:
+            profile = plannerReqs.Profile(path)
+            book = plannerReqs.RecipeBook(data, profile)
+            profile.setRecipeBook(book)
+            results = []
+            for useGlobalConstraints in [True, False]:
+                for presolve in [True, False]:
+                    constructor = csp.MealPlanCSPConstructor(book, profile, \
+                        useGlobalConstraints, presolve)
+                    constructSeconds, mealCSP = time_quietly(constructor.get_basic_csp)
+                    seconds, search = time_solve(mealCSP, mcv = True, ac3 = True, \
+                        optimize = True, iterative = True)
+                    print "%-12s %-10s %-8s %10d %10.3f %12.3f %12.6g %12d" % (name, \
+                        'global' if useGlobalConstraints else 'auxiliary', \
+                        'on' if presolve else 'off', mealCSP.numVars, constructSeconds, \
+                        seconds, search.optimalWeight, search.numOptimalAssignments)
+                    results.append((search.optimalWeight, search.numOptimalAssignments))
+            assert all(abs(weight - results[0][0]) <= 1e-9 * results[0][0] and \
+                count == results[0][1] for weight, count in results), \
+                "the encodings disagree on the %s profile: %s" % (name, results)
+    finally:
+        shutil.rmtree(workDir)
+
+def benchmark_pipeline(recipesPath = 'recipeData.txt', scenarios = PIPELINE_SCENARIOS, \
+        nodesPerVariable = NODES_PER_VARIABLE, timeLimit = 60.0, workDir = None):
+    """
+    Times the meal planner end to end on each of |scenarios|: a book of
+    recipes sampled from |recipesPath| (see write_sampled_recipes()) and a
+    profile for it (see write_synthetic_profile()). For each scenario the
+    book is loaded by parsing the text and from its cache, the RecipeBook of
+    the profile and its CSP are built, and the CSP is solved in optimize mode
+    under each of HEURISTICS, with the iterative engine. Each solve stops after
+    |nodesPerVariable| nodes per variable of the CSP, so that its work is the
+    same from run to run, or after |timeLimit| seconds.
+
+    @param workDir: Directory of the generated files, by default a new
+        temporary directory that is removed at the end.
+    @return results: A dict from scenario name to its measures, which can be
+        saved as a baseline and compared with compare_pipeline().
+    """
+    removeWorkDir = workDir is None
+    if removeWorkDir: workDir = tempfile.mkdtemp()
+    try:
+        source = recipeCache.load_recipes(recipesPath)
+        results = {}
+        print "%-8s %-22s %10s %12s %12s %10s" % ("scenario", "step", "seconds", "operations", \
+            "weight", "status")
+        for seed, (name, numRecipes, numMeals, pantrySize, calorieFactor) in enumerate(scenarios):
+            bookPath = os.path.join(workDir, '%s.txt' % name)
+            prefsPath = os.path.join(workDir, '%s.pref' % name)
+            write_sampled_recipes(bookPath, numRecipes, source, seed)
+            write_synthetic_profile(prefsPath, source, numMeals, pantrySize, calorieFactor, seed)
+            steps = {}
+            steps['parse'], data = time_quietly(recipeCache.load_recipes, bookPath, useCache = False)
+            recipeCache.compile_recipes(bookPath)
+            steps['load cached'], data = time_quietly(recipeCache.load_recipes, bookPath)
+            profile = plannerReqs.Profile(prefsPath)
+            steps['recipe book'], book = time_quietly(plannerReqs.RecipeBook, data, profile)
+            profile.setRecipeBook(book)
+            steps['construct'], mealCSP = time_quietly( \
+                csp.MealPlanCSPConstructor(book, profile).get_basic_csp)
+            for step in ['parse', 'load cached', 'recipe book', 'construct']:
+                print "%-8s %-22s %10.4f %12s %12s %10s" % (name, step, steps[step], '-', '-', '-')
+            solves = {}
+            for label, options in HEURISTICS:
+                # the iterative engine is not limited by the depth of the recursion
+                seconds, search = time_solve(mealCSP, optimize = True, \
+                    maxNodes = nodesPerVariable * mealCSP.numVars, timeLimit = timeLimit, \
+                    iterative = True, **options)
+                if search.budgetExhausted:
+                    status = 'budget' if search.optimalAssignment else 'budget, none'
+                else:
+                    status = 'optimal' if search.optimalAssignment else 'infeasible'
+                solves[label] = {'seconds': seconds, 'operations': search.numOperations, \
+                    'weight': search.optimalWeight, 'status': status}
+                print "%-8s %-22s %10.4f %12d %12.4g %10s" % (name, 'solve ' + label, seconds, \
+                    search.numOperations, search.optimalWeight or 0, status)
+            results[name] = {'recipes': numRecipes, 'meals': numMeals, 'pantry': pantrySize, \
+                'calorieFactor': calorieFactor, 'cookable': len(book.cookable), \
+                'variables': mealCSP.numVars, 'steps': steps, 'solves': solves}
+    finally:
+        if removeWorkDir: shutil.rmtree(workDir)
+    return results
+
+def compare_pipeline(results, baseline):
+    """
+    Prints the ratio of every time and operation count of the pipeline
+    |results| to that of |baseline| (both as returned by benchmark_pipeline()),
+    and the solves whose weight or status changed.
+    """
+    print "%-8s %-22s %10s %10s %10s" % ("scenario", "step", "baseline", "now", "ratio")
+    def show(name, step, before, after):
+        print "%-8s %-22s %10.4g %10.4g %10s" % (name, step, before, after, \
+            '%.2fx' % (float(after) / before) if before else '-')
+    for name, result in sorted(results.iteritems()):
+        if name not in baseline: continue
+        for step, seconds in sorted(result['steps'].iteritems()):
+            if step in baseline[name]['steps']:
+                show(name, step, baseline[name]['steps'][step], seconds)
+        for label, solve in sorted(result['solves'].iteritems()):
+            before = baseline[name]['solves'].get(label)
+            if before is None: continue
+            show(name, 'solve %s (s)' % label, before['seconds'], solve['seconds'])
+            show(name, 'solve %s (ops)' % label, before['operations'], solve['operations'])
+            if (before['status'], before['weight']) != (solve['status'], solve['weight']):
+                print "%-8s %-22s %s %g -> %s %g" % (name, 'solve ' + label, before['status'], \
+                    before['weight'] or 0, solve['status'], solve['weight'] or 0)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmarks of the meal planner.')
+    parser.add_argument('benchmarks', nargs = '*', metavar = 'benchmark', \
+        help = 'benchmarks to run (default: all but pipeline)')
+    parser.add_argument('--recipes', default = 'recipeData.txt', \
+        help = 'recipe file the pipeline books and profiles are sampled from')
+    parser.add_argument('--nodes-per-variable', type = int, default = NODES_PER_VARIABLE, \
+        help = 'node budget of each pipeline solve per variable of its CSP')
+    parser.add_argument('--time-limit', type = float, default = 60.0, \
+        help = 'time limit of each pipeline solve (s)')
+    parser.add_argument('--baseline', default = BASELINE_PATH, help = 'pipeline baseline file')
+    parser.add_argument('--save-baseline', action = 'store_true', \
+        help = 'save the pipeline results as the baseline instead of comparing with it')
+    args = parser.parse_args()
+    benchmarks = args.benchmarks or ['engines', 'bounds', 'compiled', 'parallel', \
+        'decomposition', 'eligibility', 'encodings']
+    for benchmark in benchmarks:
+        if benchmark not in ['engines', 'bounds', 'compiled', 'parallel', 'decomposition', \
+                'eligibility', 'encodings', 'pipeline']:
+            parser.error("unknown benchmark '%s'" % benchmark)
+    for i, benchmark in enumerate(benchmarks):
+        if i > 0: print
+        if benchmark == 'engines':
+            benchmark_engines()
+        elif benchmark == 'bounds':
+            benchmark_bounds()
+        elif benchmark == 'compiled':
+            benchmark_compiled(args.recipes)
+        elif benchmark == 'parallel':
+            benchmark_parallel()
+        elif benchmark == 'decomposition':
+            benchmark_decomposition()
+        elif benchmark == 'eligibility':
+            benchmark_eligibility()
+        elif benchmark == 'encodings':
+            benchmark_encodings(args.recipes)
+        elif benchmark == 'pipeline':
+            results = benchmark_pipeline(args.recipes, nodesPerVariable = args.nodes_per_variable, \
+                timeLimit = args.time_limit)
+            if args.save_baseline:
+                with open(args.baseline, 'w') as output:
+                    json.dump(results, output, indent = 2, sort_keys = True, separators = (',', ': '))
+                print "Saved the baseline to %s" % args.baseline
+            elif os.path.exists(args.baseline):
+                print
+                with open(args.baseline) as baseline:
+                    compare_pipeline(results, json.load(baseline))
@@ -1,36 +1,120 @@
 import util, collections
+import numpy as np
 class MealPlanCSPConstructor():
 
-    def __init__(self, recipebook, profile):
+    def __init__(self, recipebook, profile, useGlobalConstraints = True, presolve = True):
         """
         Saves the necessary data.
 
         @param recipebook: A recipe book with a list of recipes
         @param profile: A user's profile and requests
+        @param useGlobalConstraints: When enabled, the calorie and ingredient
+            limits, the recipe of every meal and the no-repeat rule are added
+            as native global constraints of the CSP. Otherwise they are
+            encoded with the auxiliary variables of util.get_sum_variable()
+            and util.get_or_variable(), whose domains grow with the limits,
+            and with pairwise binary factors.
+        @param presolve: When enabled, the unary constraints (cooking time,
+            hot meals, shelf life, and the calories and ingredients of a single
+            recipe) are evaluated up front by presolve() and only the
+            (recipe, meal) pairs that satisfy them become variables.
         """
+        self.book = recipebook
         self.recipebook = recipebook.recipes
         self.profile = profile
+        self.useGlobalConstraints = useGlobalConstraints
+        self.usePresolve = presolve
 
-    def get_basic_csp(self):
+    def get_basic_csp(self, stats = None):
         """
         Return a CSP that only enforces the basic constraints that a course can
         only be taken when it's offered and that a request can only be satisfied
         in at most one quarter.
 
+        @param stats: If set, a solverStats.SolverStats that records the time
+            of the 'construct' phase and of each of its steps.
         @return csp: A CSP where basic variables and constraints are added.
         """
         csp = CSP()
-        self.add_variables(csp)
-        self.add_norepeating_constraints(csp)
-        self.add_cooking_time_constraints(csp)
-        self.add_calorie_count_constraint(csp)
-        self.assign_validRecipe_everyMeal(csp)
-        self.add_ingredient_quantity_constraint(csp)
-        self.add_hot_contraints(csp)
-        self.add_recipe_weights(csp)
-        self.add_shelf_life_constraints(csp)
+        steps = [self.add_variables, self.add_norepeating_constraints]
+        if not self.usePresolve: steps.append(self.add_cooking_time_constraints)
+        steps += [self.add_calorie_count_constraint, self.assign_validRecipe_everyMeal, \
+            self.add_ingredient_quantity_constraint]
+        if not self.usePresolve: steps.append(self.add_hot_contraints)
+        steps.append(self.add_recipe_weights)
+        if not self.usePresolve: steps.append(self.add_shelf_life_constraints)
+        if stats is None:
+            self.presolve()
+            for step in steps:
+                step(csp)
+            return csp
+        with stats.phase('construct'):
+            with stats.phase('construct.presolve'):
+                self.presolve()
+            for step in steps:
+                with stats.phase('construct.' + step.__name__):
+                    step(csp)
         return csp
 
+    def presolve(self):
+        """
+        Decide which (recipe, meal) pairs become variables. With presolving,
+        the unary constraints are evaluated for all pairs at once over arrays
+        of the recipe and meal attributes, and the pairs that can never be
+        taken are dropped, along with the recipes left without any meal.
+        Otherwise every pair is kept.
+
+        Sets self.variables, the kept pairs in (recipe, meal) order,
+        self.mealVariables and self.recipeVariables, the kept pairs of every
+        meal and of every recipe, and self.numPairs, the number of pairs
+        before presolving.
+        """
+        requests = self.profile.requests
+        meals = self.profile.meals
+        if self.usePresolve:
+            maxTimes = np.array([self.profile.mealsToMaxTimes[meal] for meal in meals])
+            hotMeals = np.array([meal in self.profile.hotMeals for meal in meals], dtype=bool)
+            # a recipe taken at the i-th meal must keep for i days
+            mealDays = np.arange(1, len(meals) + 1)
+            # rows of the requested recipes in the columns of the recipe book
+            rows = np.array([req.index for req in requests], dtype=int)
+            cookingTimes = self.book.cookingTimes[rows]
+            hotVerbs = self.read_hot_verbs("hotVerbs.txt")
+            hot = np.array([self.is_hot(hotVerbs, req) for req in requests], dtype=bool)
+            shelfLives = self.book.shelfLives[rows]
+            fits = self.book.calorieCounts[rows] <= self.profile.maxTotalCalories
+            if self.profile.availableIngreds is not None:
+                fits &= self.book.within_quantities(self.profile.availableIngreds)[rows]
+            live = (cookingTimes[:, np.newaxis] <= maxTimes[np.newaxis, :]) \
+                & (hot[:, np.newaxis] | ~hotMeals[np.newaxis, :]) \
+                & (shelfLives[:, np.newaxis] >= mealDays[np.newaxis, :]) \
+                & fits[:, np.newaxis]
+        else:
+            live = np.ones((len(requests), len(meals)), dtype=bool)
+        live = live.reshape(len(requests), len(meals))
+
+        self.numPairs = live.size
+        self.variables = [(requests[r], meals[m]) for r, m in zip(*np.nonzero(live))]
+        self.mealVariables = {meal: [] for meal in meals}
+        self.recipeVariables = collections.OrderedDict()
+        for req, meal in self.variables:
+            self.mealVariables[meal].append((req, meal))
+            self.recipeVariables.setdefault(req, []).append((req, meal))
+
+    def read_hot_verbs(self, fileName):
+        hotVerbs = []
+        with open(fileName, 'rb') as dataset:
+            for line in dataset:
+                line = line.replace("\n","")
+                hotVerbs.append(line)
+        return hotVerbs
+
+    def is_hot(self, hotVerbs, recipe):
+        for verb in hotVerbs:
+            if verb in recipe.getInstructions():
+                return True
+        return False
+
     def add_variables(self, csp):
         """
         Adding the variables into the CSP. Each variable, (recipe, day),
@@ -38,9 +122,8 @@ class MealPlanCSPConstructor():
 
         @param csp: The CSP where the additional constraints will be added to.
         """
-        for req in self.profile.requests:
-            for meal in self.profile.meals:
-                csp.add_variable((req, meal), [True, False])
+        for var in self.variables:
+            csp.add_variable(var, [True, False])
 
     def add_norepeating_constraints(self, csp):
         """
@@ -48,80 +131,91 @@ class MealPlanCSPConstructor():
 
         @param csp: The CSP where the additional constraints will be added to.
         """
-        for req in self.profile.requests:
-            for meal in self.profile.meals:
-                for meal2 in self.profile.meals:
-                    if meal == meal2: continue
-                    csp.add_binary_factor((req, meal), (req, meal2), \
-                        lambda taken1, taken2: not (taken1 and taken2))
+        for variables in self.recipeVariables.values():
+            if self.useGlobalConstraints:
+                csp.add_at_most_one_constraint(variables, [True])
+                continue
+            for var in variables:
+                for var2 in variables:
+                    if var == var2: continue
+                    csp.add_binary_factor(var, var2, \
+                        lambda taken1, taken2: ~(taken1 & taken2), vectorized = True)
 
     def assign_validRecipe_everyMeal(self, csp):
         for meal in self.profile.meals:
-            requests = []
-            for req in self.profile.requests:
-                requests.append((req, meal))
+            requests = self.mealVariables[meal]
+            if self.useGlobalConstraints:
+                if not requests:
+                    # no recipe is left for the meal (presolve dropped them all):
+                    # a variable of weight 0 makes the CSP infeasible for every
+                    # solver, while a count constraint over no variables would
+                    # be dropped by solve_decomposed()
+                    csp.add_variable(('empty', meal), [False])
+                    csp.add_unary_factor(('empty', meal), lambda val: 0.0)
+                    continue
+                csp.add_count_constraint(requests, [True], minCount = 1)
+                continue
             orVar = util.get_or_variable(csp, (meal), requests, True)    
             csp.add_unary_factor(orVar, lambda v: True if v else False)
 
     def add_cooking_time_constraints(self, csp):
-        for req in self.profile.requests:
-            for meal in self.profile.meals:
-                csp.add_unary_factor((req, meal), lambda taken1: req.getCookingTime() <= self.profile.mealsToMaxTimes[meal] if taken1 else True)
+        for req, meal in self.variables:
+            csp.add_unary_factor((req, meal), lambda taken1: req.getCookingTime() <= self.profile.mealsToMaxTimes[meal] if taken1 else True)
 
     def add_hot_contraints(self,csp):
-        def readHotVerbs(fileName):
-            hotVerbs = []
-            with open(fileName, 'rb') as dataset:
-                for line in dataset:
-                    line = line.replace("\n","")
-                    hotVerbs.append(line)
-            return hotVerbs
-        def isHot(hotVerbs, recipe):
-            for verb in hotVerbs:
-                if verb in recipe.getInstructions():
-                    return True
-            return False
-        hotVerbs = readHotVerbs("hotVerbs.txt")
-        for req in self.profile.requests:
-            for meal in self.profile.meals:
-                if meal in self.profile.hotMeals:
-                    csp.add_unary_factor((req, meal), lambda taken1: isHot(hotVerbs, req) if taken1 else True)
+        hotVerbs = self.read_hot_verbs("hotVerbs.txt")
+        for req, meal in self.variables:
+            if meal in self.profile.hotMeals:
+                csp.add_unary_factor((req, meal), lambda taken1: self.is_hot(hotVerbs, req) if taken1 else True)
 
     def add_calorie_count_constraint(self, csp):
+        if self.useGlobalConstraints:
+            csp.add_sum_constraint(self.variables, self.profile.maxTotalCalories, \
+                lambda var, taken: var[0].getCalorieCount() if taken else 0)
+            return
+        if self.profile.maxTotalCalories == float('inf'): return
         varsList = []
-        for req in self.profile.requests:
-            for meal in self.profile.meals:
-                var = (req.rid, meal)
-                csp.add_variable(var, [0,req.getCalorieCount()])
-                varsList.append(var)
-                csp.add_binary_factor((req, meal), var, lambda taken1, calorieCount: calorieCount > 0 if taken1 else calorieCount == 0 )
+        for req, meal in self.variables:
+            var = (req.rid, meal)
+            csp.add_variable(var, [0,req.getCalorieCount()])
+            varsList.append(var)
+            csp.add_binary_factor((req, meal), var, lambda taken1, calorieCount: calorieCount > 0 if taken1 else calorieCount == 0 )
         util.get_sum_variable(csp, "total", varsList, self.profile.maxTotalCalories)
 
     def add_ingredient_quantity_constraint(self, csp):
+        if self.profile.availableIngreds is None: return
         for ingred in self.profile.availableIngreds:
+            # an ingredient without a limit constrains nothing
+            if self.profile.availableIngreds[ingred] == float('inf'): continue
+            if self.useGlobalConstraints:
+                variables = [(req, meal) for req, meal in self.variables \
+                    if req.getQuantity(ingred) > 0]
+                csp.add_sum_constraint(variables, self.profile.availableIngreds[ingred], \
+                    lambda var, taken: var[0].getQuantity(ingred) if taken else 0)
+                continue
             varsList = []
-            for req in self.profile.requests:
-                if req.getIngredients()[ingred] > 0:
-                    for meal in self.profile.meals:                    
-                        var = (req.rid, meal, ingred)
-                        if ingred in req.getIngredients():
-                            csp.add_variable(var, [0,req.getIngredients()[ingred]])
-                        else:
-                            csp.add_variable(var, [0])
-                        varsList.append(var)
-                        csp.add_binary_factor((req, meal), var, lambda taken1, ingredQty: ingredQty > 0 if taken1 else ingredQty == 0 )
+            for req, meal in self.variables:
+                if req.getQuantity(ingred) > 0:
+                    var = (req.rid, meal, ingred)
+                    if req.getQuantity(ingred) > 0:
+                        csp.add_variable(var, [0,req.getQuantity(ingred)])
+                    else:
+                        csp.add_variable(var, [0])
+                    varsList.append(var)
+                    csp.add_binary_factor((req, meal), var, lambda taken1, ingredQty: ingredQty > 0 if taken1 else ingredQty == 0 )
             util.get_sum_variable(csp, ingred + "total", varsList, self.profile.availableIngreds[ingred])
 
     def add_recipe_weights(self, csp):
-        for req in self.profile.requests:
+        for req, variables in self.recipeVariables.iteritems():
             weight = req.getRating()
-            for meal in self.profile.meals:
-                csp.add_unary_factor((req, meal), lambda taken: weight if taken else 1.0)
+            for var in variables:
+                csp.add_unary_factor(var, lambda taken: weight if taken else 1.0)
 
     def add_shelf_life_constraints(self, csp):
-        for req in self.profile.requests:
-            for idx, meal in enumerate(self.profile.meals):
-                csp.add_unary_factor((req, meal), lambda taken1: min(req.getShelfLife().values()) >= idx+1 if taken1 else True)
+        for idx, meal in enumerate(self.profile.meals):
+            for var in self.mealVariables[meal]:
+                req = var[0]
+                csp.add_unary_factor(var, lambda taken1: min(req.getShelfLife().values()) >= idx+1 if taken1 else True)
 
 # General code for representing a weighted CSP (Constraint Satisfaction Problem).
 # All variables are being referenced by their index instead of their original
@@ -161,14 +255,33 @@ class CSP:
         # then binaryFactors[A][B]['b']['a'] == f1('b','a') * f2('b','a').
         # binaryFactors[A][A] should return a key error since a variable
         # shouldn't have a binary factor table with itself.
+        # Until it is first read, a table is a LazyFactorDict that builds the
+        # dictionary from binaryFactorArrays (see below).
 
         self.binaryFactors = {}
 
+        # The same factor tables as NumPy arrays, where each row is a value of
+        # the first variable in domain order: unaryFactorArrays[K] is a 1-D
+        # array (or None) and binaryFactorArrays[A][B] a 2-D array. The table
+        # of each pair is stored once; binaryFactorArrays[B][A] is a
+        # transposed view of binaryFactorArrays[A][B].
+        self.unaryFactorArrays = {}
+        self.binaryFactorArrays = {}
+
+        # The list of global constraints, each over any number of variables:
+        # SumConstraint, CountConstraint or AllDifferentConstraint. They are not turned into factor tables but
+        # enforced by the solver through their own propagation.
+        self.globalConstraints = []
+
+        # Each key K in this dictionary is a variable name. The value is the
+        # list of indices in globalConstraints of the constraints involving K.
+        self.variableConstraints = {}
+
     def add_variable(self, var, domain):
         """
         Add a new variable to the CSP.
         """
-        if var in self.variables:
+        if var in self.values:
             raise Exception("Variable name already exists: %s" % str(var))
 
         self.numVars += 1
@@ -176,6 +289,9 @@ class CSP:
         self.values[var] = domain
         self.unaryFactors[var] = None
         self.binaryFactors[var] = dict()
+        self.unaryFactorArrays[var] = None
+        self.binaryFactorArrays[var] = dict()
+        self.variableConstraints[var] = []
 
 
     def get_neighbor_vars(self, var):
@@ -184,7 +300,84 @@ class CSP:
         """
         return self.binaryFactors[var].keys()
 
-    def add_unary_factor(self, var, factorFunc):
+    def decode(self, assignment):
+        """
+        Returns a copy of a complete |assignment|, keyed by variable name in
+        the order the variables were added.
+        """
+        return {var: assignment[var] for var in self.variables}
+
+    def get_components(self):
+        """
+        Returns the connected components of the constraint graph, where two
+        variables are linked when they share a binary factor or a global
+        constraint. Each component is a list of variables in the order they
+        were added, and the components are ordered by their first variable.
+        """
+        position = {var: i for i, var in enumerate(self.variables)}
+        seen = set()
+        components = []
+        for var in self.variables:
+            if var in seen: continue
+            seen.add(var)
+            component = [var]
+            # a global constraint links all its variables at once, so each is
+            # expanded only once
+            expanded = set()
+            for current in component:
+                neighbors = list(self.binaryFactors[current])
+                for index in self.variableConstraints[current]:
+                    if index not in expanded:
+                        expanded.add(index)
+                        neighbors.extend(self.globalConstraints[index].variables)
+                for neighbor in neighbors:
+                    if neighbor not in seen:
+                        seen.add(neighbor)
+                        component.append(neighbor)
+            component.sort(key = position.get)
+            components.append(component)
+        return components
+
+    def is_tree(self, component):
+        """
+        Returns whether the connected |component| (see get_components()) is a
+        tree of binary factors, with no global constraint.
+        """
+        if any(self.variableConstraints[var] for var in component): return False
+        numEdges = sum(len(self.binaryFactors[var]) for var in component) / 2
+        return numEdges == len(component) - 1
+
+    def get_sub_csp(self, variables):
+        """
+        Returns the CSP over |variables| alone, a union of components (see
+        get_components()). It shares the domains, factor tables and global
+        constraints of this CSP, which should not be modified while it is in
+        use.
+        """
+        sub = CSP()
+        for var in variables:
+            sub.numVars += 1
+            sub.variables.append(var)
+            sub.values[var] = self.values[var]
+            sub.unaryFactors[var] = self.unaryFactors[var]
+            sub.binaryFactors[var] = self.binaryFactors[var]
+            sub.unaryFactorArrays[var] = self.unaryFactorArrays[var]
+            sub.binaryFactorArrays[var] = self.binaryFactorArrays[var]
+            sub.variableConstraints[var] = []
+        for index in sorted(set(index for var in variables \
+                for index in self.variableConstraints[var])):
+            sub.add_global_constraint(self.globalConstraints[index])
+        return sub
+
+    def compile(self):
+        """
+        Returns a CompiledCSP where variables and domain values are replaced
+        by dense integers and all factor tables are lists indexed by them. The
+        CSP should not be modified while the compiled copy is in use.
+        """
+        return CompiledCSP(self)
+
+    def add_unary_factor(self, var, factorFunc, vectorized = False):
         """
         Add a unary factor function for a variable. Its factor
         value across the domain will be *merged* with any previously added
@@ -193,16 +386,21 @@ class CSP:
         How to get unary factor value given a variable |var| and
         value |val|?
         => csp.unaryFactors[var][val]
+
+        @param factorFunc: A function of one value, or a NumPy array of the
+            factor values in domain order.
+        @param vectorized: If True, |factorFunc| is called only once, on the
+            NumPy array of all the values of |var|.
         """
-        factor = {val:float(factorFunc(val)) for val in self.values[var]}
-        if self.unaryFactors[var] is not None:
-            assert len(self.unaryFactors[var]) == len(factor)
-            self.unaryFactors[var] = {val:self.unaryFactors[var][val] * \
-                factor[val] for val in factor}
+        factor = self.get_factor_array(factorFunc, vectorized, var)
+        if self.unaryFactorArrays[var] is not None:
+            self.unaryFactorArrays[var] *= factor
         else:
-            self.unaryFactors[var] = factor
+            self.unaryFactorArrays[var] = factor
+        self.unaryFactors[var] = dict(zip(self.values[var], \
+            self.unaryFactorArrays[var].tolist()))
 
-    def add_binary_factor(self, var1, var2, factor_func):
+    def add_binary_factor(self, var1, var2, factor_func, vectorized = False):
         """
         Takes two variable names and a binary factor function
         |factorFunc|, add to binaryFactors. If the two variables already
@@ -212,6 +410,12 @@ class CSP:
         How to get binary factor value given a variable |var1| with value |val1| 
         and variable |var2| with value |val2|?
         => csp.binaryFactors[var1][var2][val1][val2]
+
+        @param factor_func: A function of two values, or a NumPy array of shape
+            (len(domain of var1), len(domain of var2)) of the factor values.
+        @param vectorized: If True, |factor_func| is called only once, on the
+            NumPy arrays of the values of |var1| as a column and of |var2| as
+            a row, and its result is broadcast to the table shape.
         """
         # never shall a binary factor be added over a single variable
         try:
@@ -225,24 +429,443 @@ class CSP:
             raise
 
         self.update_binary_factor_table(var1, var2,
-            {val1: {val2: float(factor_func(val1, val2)) \
-                for val2 in self.values[var2]} for val1 in self.values[var1]})
-        self.update_binary_factor_table(var2, var1, \
-            {val2: {val1: float(factor_func(val1, val2)) \
-                for val1 in self.values[var1]} for val2 in self.values[var2]})
+            self.get_factor_array(factor_func, vectorized, var1, var2))
+
+    def get_value_array(self, var):
+        """
+        Returns the domain of |var| as a 1-D NumPy array, of dtype object if
+        its values are not scalars (e.g. tuples).
+        """
+        values = np.array(self.values[var])
+        if values.ndim != 1:
+            values = np.empty(len(self.values[var]), dtype=object)
+            for i, val in enumerate(self.values[var]):
+                values[i] = val
+        return values
+
+    def get_factor_array(self, factorFunc, vectorized, *variables):
+        """
+        Returns the factor table of |factorFunc| over the domains of the one or
+        two |variables| as a float array. See add_unary_factor() and
+        add_binary_factor() for the forms |factorFunc| can take.
+        """
+        shape = tuple(len(self.values[var]) for var in variables)
+        if isinstance(factorFunc, np.ndarray):
+            factor = np.array(factorFunc, dtype=float)
+        elif vectorized:
+            if len(variables) == 1:
+                args = [self.get_value_array(variables[0])]
+            else:
+                args = [self.get_value_array(variables[0])[:, np.newaxis], \
+                    self.get_value_array(variables[1])[np.newaxis, :]]
+            factor = np.array(np.broadcast_to(factorFunc(*args), shape), dtype=float)
+        elif len(variables) == 1:
+            factor = np.array([float(factorFunc(val)) for val in self.values[variables[0]]], \
+                dtype=float)
+        else:
+            values2 = self.values[variables[1]]
+            factor = np.array([[float(factorFunc(val1, val2)) for val2 in values2] \
+                for val1 in self.values[variables[0]]], dtype=float).reshape(shape)
+        assert factor.shape == shape
+        return factor
+
+    def add_sum_constraint(self, variables, maxSum, contribFunc = None):
+        """
+        Add a global constraint that the contributions of |variables| sum up to
+        at most |maxSum|. Unlike util.get_sum_variable(), this does not add any
+        auxiliary variable or factor table.
+
+        @param contribFunc: contribFunc(var, val) gives the number that var = val
+            adds to the sum. By default it is the value itself.
+        """
+        if contribFunc is None:
+            contribFunc = lambda var, val: val
+        contributions = {var: {val: float(contribFunc(var, val)) for val in self.values[var]} \
+            for var in variables}
+        self.add_global_constraint(SumConstraint(variables, contributions, maxSum))
+
+    def add_linear_constraint(self, coefficients, maxSum):
+        """
+        Add a global constraint that the sum of coefficients[var] * var over
+        the variables in |coefficients| is at most |maxSum|.
+        """
+        self.add_sum_constraint(coefficients.keys(), maxSum, \
+            lambda var, val: coefficients[var] * val)
+
+    def add_count_constraint(self, variables, values, minCount = 0, maxCount = None):
+        """
+        Add a global constraint that between |minCount| and |maxCount| (by
+        default all) of |variables| take one of the |values|. Unlike
+        util.get_or_variable() or pairwise binary factors, this does not add
+        any auxiliary variable or factor table.
+        """
+        counted = {var: set(val for val in self.values[var] if val in values) \
+            for var in variables}
+        self.add_global_constraint(CountConstraint(variables, counted, minCount, maxCount))
+
+    def add_at_most_one_constraint(self, variables, values):
+        """
+        Add a global constraint that at most one of |variables| takes one of the
+        |values|.
+        """
+        self.add_count_constraint(variables, values, 0, 1)
+
+    def add_exactly_one_constraint(self, variables, values):
+        """
+        Add a global constraint that exactly one of |variables| takes one of the
+        |values|.
+        """
+        self.add_count_constraint(variables, values, 1, 1)
+
+    def add_alldiff_constraint(self, variables):
+        """
+        Add a global constraint that no two of |variables| take the same value.
+        """
+        self.add_global_constraint(AllDifferentConstraint(variables))
+
+    def add_global_constraint(self, constraint):
+        """
+        Add a global constraint object, which lists the variables it involves
+        in constraint.variables.
+        """
+        index = len(self.globalConstraints)
+        self.globalConstraints.append(constraint)
+        for var in constraint.variables:
+            self.variableConstraints[var].append(index)
 
     def update_binary_factor_table(self, var1, var2, table):
         """
         Private method you can skip for 0c, might be useful for 1c though.
-        Update the binary factor table for binaryFactors[var1][var2].
-        If it exists, element-wise multiplications will be performed to merge
-        them together.
+        Update the binary factor table for binaryFactors[var1][var2], and
+        binaryFactors[var2][var1] with it. If it exists, one element-wise
+        multiplication of the arrays will be performed to merge them together.
+
+        @param table: A float array of shape (len(domain of var1),
+            len(domain of var2)), or a nested dictionary like binaryFactors.
         """
-        if var2 not in self.binaryFactors[var1]:
-            self.binaryFactors[var1][var2] = table
+        if not isinstance(table, np.ndarray):
+            table = np.array([[table[val1][val2] for val2 in self.values[var2]] \
+                for val1 in self.values[var1]], dtype=float).reshape( \
+                len(self.values[var1]), len(self.values[var2]))
+        if var2 not in self.binaryFactorArrays[var1]:
+            self.binaryFactorArrays[var1][var2] = table
+            self.binaryFactorArrays[var2][var1] = table.T
         else:
-            currentTable = self.binaryFactors[var1][var2]
-            for i in table:
-                for j in table[i]:
-                    assert i in currentTable and j in currentTable[i]
-                    currentTable[i][j] *= table[i][j]
+            # in place, so that the transposed view of the reverse direction
+            # is merged too
+            self.binaryFactorArrays[var1][var2] *= table
+        # the nested dictionaries are only built if the dict-based search
+        # reads them, not on every merge nor for a compiled CSP
+        self.binaryFactors[var1][var2] = LazyFactorDict(self, var1, var2)
+        self.binaryFactors[var2][var1] = LazyFactorDict(self, var2, var1)
+
+    def get_factor_dict(self, var1, var2, table):
+        """
+        Returns the nested dictionary view of the binary factor array |table|,
+        as stored in binaryFactors[var1][var2].
+        """
+        values2 = self.values[var2]
+        return {val1: dict(zip(values2, row)) \
+            for val1, row in zip(self.values[var1], table.tolist())}
+
+# Stand-in for the nested dictionary binaryFactors[var1][var2] of a CSP until
+# it is first read: the first lookup builds the dictionary view of
+# binaryFactorArrays[var1][var2] and puts it in its place, so that later
+# lookups go to the dictionary directly.
+class LazyFactorDict:
+    def __init__(self, csp, var1, var2):
+        self.csp = csp
+        self.var1 = var1
+        self.var2 = var2
+        self.factorDict = None
+
+    def __getitem__(self, val1):
+        if self.factorDict is None:
+            self.factorDict = self.csp.get_factor_dict(self.var1, self.var2, \
+                self.csp.binaryFactorArrays[self.var1][self.var2])
+            self.csp.binaryFactors[self.var1][self.var2] = self.factorDict
+        return self.factorDict[val1]
+
+# Integer-indexed form of a CSP, built by CSP.compile(). Variable |i| is the
+# i-th variable added to the original CSP and its values are the positions
+# 0 .. len(domain)-1 in the original domain, so a solver written against CSP
+# runs unchanged on it:
+#   unaryFactors[i] is a list (or None), unaryFactors[i][a]
+#   binaryFactors[i][j] is a list of rows, binaryFactors[i][j][a][b]
+# The tables are plain Python lists, which are faster than dictionaries or
+# NumPy arrays to read one entry at a time during the search. The NumPy
+# arrays of the original CSP are shared, not copied, in unaryFactorArrays and
+# binaryFactorArrays, for operations over whole tables.
+class CompiledCSP:
+    def __init__(self, csp):
+        self.numVars = csp.numVars
+        self.variables = range(csp.numVars)
+
+        # Original variable names and domain values, used to decode results.
+        self.varNames = list(csp.variables)
+        self.domainValues = [list(csp.values[var]) for var in csp.variables]
+        self.varIndex = {var: i for i, var in enumerate(csp.variables)}
+
+        self.values = [range(len(domain)) for domain in self.domainValues]
+
+        self.unaryFactorArrays = [csp.unaryFactorArrays[var] for var in csp.variables]
+        self.unaryFactors = [None if factor is None else factor.tolist() \
+            for factor in self.unaryFactorArrays]
+
+        # neighborFactors[i] lists (j, binaryFactors[i][j]) in the same order
+        # as the original CSP, so products of factors are formed in the same
+        # order as in the dict-based representation.
+        self.binaryFactorArrays = [dict() for var in self.variables]
+        self.binaryFactors = [dict() for var in self.variables]
+        self.neighborFactors = [[] for var in self.variables]
+        self.neighbors = [[] for var in self.variables]
+        for i, var1 in enumerate(csp.variables):
+            for var2 in csp.binaryFactors[var1]:
+                j = self.varIndex[var2]
+                self.binaryFactorArrays[i][j] = csp.binaryFactorArrays[var1][var2]
+                self.binaryFactors[i][j] = self.binaryFactorArrays[i][j].tolist()
+                self.neighborFactors[i].append((j, self.binaryFactors[i][j]))
+                self.neighbors[i].append(j)
+
+        self.globalConstraints = [constraint.compile(self) for constraint in csp.globalConstraints]
+        self.variableConstraints = [csp.variableConstraints[var] for var in csp.variables]
+
+        # supports[i][j][a][b] is True iff binaryFactors[i][j][a][b] != 0. Used
+        # by AC-3 to revise an arc between large domains at once.
+        self.supports = [{j: factor != 0 for j, factor in neighbors.iteritems()} \
+            for neighbors in self.binaryFactorArrays]
+
+    def get_neighbor_vars(self, var):
+        """
+        Returns a list of variables which are neighbors of |var|.
+        """
+        return self.neighbors[var]
+
+    def compile(self):
+        """
+        A CompiledCSP is already compiled: returns itself.
+        """
+        return self
+
+    def decode(self, assignment):
+        """
+        Translates a complete |assignment| of integer variables and values
+        back to the variable names and domain values of the original CSP.
+        """
+        return {self.varNames[var]: self.domainValues[var][val] \
+            for var, val in assignment.iteritems()}
+
+# Global constraint that the contributions of |variables| sum up to at most
+# |maxSum|, where contributions[var][val] is what var = val adds to the sum.
+#
+# The solver keeps a state for it: a one-element list holding the slack, i.e.
+# maxSum minus the contributions of the assigned variables and the smallest
+# contributions of the unassigned ones. Propagation is bounds consistency: a
+# value is pruned when its contribution exceeds the smallest one of its
+# variable by more than the slack.
+class SumConstraint:
+    # Absolute tolerance for rounding errors in the slack.
+    tolerance = 1e-9
+
+    def __init__(self, variables, contributions, maxSum):
+        self.variables = list(variables)
+        self.contributions = contributions
+        self.maxSum = maxSum
+        self.minContributions = {var: min(contributions[var].values() or [0.0]) \
+            for var in self.variables}
+        # (excess over the smallest contribution, var, val) for every value
+        # with a positive excess, largest excess first.
+        self.excesses = [(contributions[var][val] - self.minContributions[var], var, val) \
+            for var in self.variables for val in contributions[var]]
+        self.excesses = sorted([excess for excess in self.excesses if excess[0] > 0], \
+            key = lambda excess: -excess[0])
+
+    def initial_state(self):
+        return [self.maxSum - sum(self.minContributions.values())]
+
+    def assign(self, state, var, val, sign):
+        """
+        Update |state| for |var| being assigned |val| (|sign| = 1) or for that
+        assignment being undone (|sign| = -1).
+        """
+        state[0] -= sign * (self.contributions[var][val] - self.minContributions[var])
+
+    def propagate(self, state, search, var):
+        """
+        Prune, through search.prune_value(), the values of unassigned variables
+        that would exceed the sum after |var| was assigned (None at the root).
+
+        @return consistent: False if the constraint can no longer be satisfied.
+        """
+        slack = state[0] + self.tolerance
+        if slack < 0: return False
+        for excess, var2, val2 in self.excesses:
+            if excess <= slack: break
+            if var2 in search.assignment: continue
+            if search.prune_value(var2, val2) and search.domain_size(var2) == 0:
+                return False
+        return True
+
+    def compile(self, compiledCSP):
+        """
+        Returns this constraint over the variable and value indices of
+        |compiledCSP|.
+        """
+        contributions = {}
+        for var in self.variables:
+            i = compiledCSP.varIndex[var]
+            contributions[i] = {a: self.contributions[var][val] \
+                for a, val in enumerate(compiledCSP.domainValues[i])}
+        return SumConstraint([compiledCSP.varIndex[var] for var in self.variables], \
+            contributions, self.maxSum)
+
+# Global constraint that between |minCount| and |maxCount| of |variables| take
+# one of their counted values, where counted[var] is the set of values of var
+# that count. At-least-one, at-most-one and exactly-one constraints are the
+# special cases (1, None), (0, 1) and (1, 1).
+#
+# The solver keeps a state for it: a one-element list holding the number of
+# assigned variables with a counted value. Propagation prunes the counted
+# values of the unassigned variables once maxCount is reached, and their
+# other values when every remaining candidate is needed to reach minCount.
+class CountConstraint:
+    def __init__(self, variables, counted, minCount = 0, maxCount = None):
+        self.variables = list(variables)
+        self.counted = counted
+        self.minCount = minCount
+        self.maxCount = len(self.variables) if maxCount is None else maxCount
+        # No assignment can satisfy the constraint, e.g. at least one of no
+        # variables.
+        self.infeasible = minCount > min(len(self.variables), self.maxCount)
+
+    def initial_state(self):
+        return [0]
+
+    def assign(self, state, var, val, sign):
+        """
+        Update |state| for |var| being assigned |val| (|sign| = 1) or for that
+        assignment being undone (|sign| = -1).
+        """
+        if val in self.counted[var]:
+            state[0] += sign
+
+    def propagate(self, state, search, var):
+        """
+        Prune, through search.prune_value(), the values of unassigned variables
+        that would break the count after |var| was assigned (None at the root).
+
+        @return consistent: False if the constraint can no longer be satisfied.
+        """
+        count = state[0]
+        if self.infeasible or count > self.maxCount: return False
+        if count < self.maxCount and count >= self.minCount: return True
+        unassigned = [var2 for var2 in self.variables if var2 not in search.assignment]
+        if count == self.maxCount:
+            # no counted value can be taken anymore, so minCount must already
+            # be reached
+            if count < self.minCount: return False
+            for var2 in unassigned:
+                for val2 in self.counted[var2]:
+                    if search.prune_value(var2, val2) and search.domain_size(var2) == 0:
+                        return False
+            return True
+        # Every variable that can still take a counted value is a candidate.
+        candidates = [var2 for var2 in unassigned \
+            if any(search.in_domain(var2, val2) for val2 in self.counted[var2])]
+        if count + len(candidates) < self.minCount: return False
+        if count + len(candidates) == self.minCount:
+            for var2 in candidates:
+                for val2 in list(search.get_domain_values(var2)):
+                    if val2 not in self.counted[var2]:
+                        search.prune_value(var2, val2)
+        return True
+
+    def compile(self, compiledCSP):
+        """
+        Returns this constraint over the variable and value indices of
+        |compiledCSP|.
+        """
+        counted = {}
+        for var in self.variables:
+            i = compiledCSP.varIndex[var]
+            counted[i] = set(a for a, val in enumerate(compiledCSP.domainValues[i]) \
+                if val in self.counted[var])
+        return CountConstraint([compiledCSP.varIndex[var] for var in self.variables], \
+            counted, self.minCount, self.maxCount)
+
+# Global constraint that no two of |variables| take the same value.
+#
+# The solver keeps a state for it: a one-element list holding a dictionary
+# from each value taken by an assigned variable to the number of such
+# variables. Propagation is forward checking (the value of an assigned
+# variable is pruned from the others) plus a pigeonhole check that the
+# unassigned variables still have enough distinct values between them.
+#
+# keys[var][val] is the value compared for var = val; for the original CSP it
+# is val itself, for a compiled CSP it maps the value index back to the
+# original value so that variables with different domains can be compared.
+class AllDifferentConstraint:
+    def __init__(self, variables, keys = None):
+        self.variables = list(variables)
+        if keys is None:
+            keys = {var: None for var in self.variables}
+        self.keys = keys
+        # values[var][key] is the value of var compared as key, if any.
+        self.values = {}
+        for var in self.variables:
+            if keys[var] is None:
+                self.values[var] = None
+            else:
+                self.values[var] = {key: val for val, key in keys[var].iteritems()}
+
+    def initial_state(self):
+        return [collections.Counter()]
+
+    def key(self, var, val):
+        return val if self.keys[var] is None else self.keys[var][val]
+
+    def value(self, var, key):
+        """
+        Returns the value of |var| compared as |key|, or None if |var| has none.
+        """
+        if self.values[var] is None: return key
+        return self.values[var].get(key)
+
+    def assign(self, state, var, val, sign):
+        """
+        Update |state| for |var| being assigned |val| (|sign| = 1) or for that
+        assignment being undone (|sign| = -1).
+        """
+        state[0][self.key(var, val)] += sign
+
+    def propagate(self, state, search, var):
+        """
+        Prune, through search.prune_value(), the value of |var| from the other
+        unassigned variables (nothing at the root).
+
+        @return consistent: False if the constraint can no longer be satisfied.
+        """
+        unassigned = [var2 for var2 in self.variables if var2 not in search.assignment]
+        if var is not None:
+            key = self.key(var, search.assignment[var])
+            if state[0][key] > 1: return False
+            for var2 in unassigned:
+                val2 = self.value(var2, key)
+                if val2 is not None and search.prune_value(var2, val2) \
+                        and search.domain_size(var2) == 0:
+                    return False
+        keys = set()
+        for var2 in unassigned:
+            keys.update(self.key(var2, val2) for val2 in search.get_domain_values(var2))
+        return len(keys) >= len(unassigned)
+
+    def compile(self, compiledCSP):
+        """
+        Returns this constraint over the variable and value indices of
+        |compiledCSP|.
+        """
+        keys = {}
+        for var in self.variables:
+            i = compiledCSP.varIndex[var]
+            keys[i] = {a: self.key(var, val) for a, val in enumerate(compiledCSP.domainValues[i])}
+        return AllDifferentConstraint([compiledCSP.varIndex[var] for var in self.variables], keys)
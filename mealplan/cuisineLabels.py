@@ -0,0 +1,196 @@
+import hashlib, json, os, warnings
+import numpy as np
+import cuisineModel
+
+# Cuisine of the recipes of a RecipeData, filled lazily the first time a
+# recipe is asked for, so loading a book costs nothing. The rows are labeled
+# BLOCK_SIZE at a time, each label taken from the first source that has it:
+#   1. the persistent cache of the recipe file (|recipesPath| + '.cuisines')
+#   2. the label file written by the classifier, LABELS_PATH
+#   3. a batched prediction of the saved classifier at MODEL_PATH (see
+#      cuisineModel), if there is one
+# A recipe is identified by its rid and the hash of its ingredient names (see
+# get_ingredient_hash()), so an edited recipe is labeled again. The labels
+# found in 2. and 3. are appended to the cache, which is started over when
+# the label file or the model change. A recipe no source can label has the
+# cuisine None, and is not cached.
+#
+# The cache is a text file whose first line is '#' and the JSON signature of
+# the label file and the model, followed by one 'rid<TAB>hash<TAB>cuisine'
+# line per recipe.
+
+LABELS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', \
+    'cuisineClassifier', 'recipeWithCuisines.txt')
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', \
+    'cuisineClassifier', 'cuisineModel')
+BLOCK_SIZE = 4096
+
+def get_ingredient_hash(ingredients):
+    """
+    Returns the hash identifying the set of ingredient names |ingredients|,
+    which is all the classifier looks at.
+    """
+    return hashlib.sha1('\n'.join(sorted(set(ingredients)))).hexdigest()[:16]
+
+def get_file_signature(path):
+    """
+    Returns the [mtime, size] of the file |path|, or None if it is missing.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime, stat.st_size]
+
+def read_label_file(labelsPath):
+    """
+    Reads the label file |labelsPath|, where each line is a recipe line of the
+    format of recipeData.txt followed by '<>' and its cuisine.
+
+    @return labels: A dict from (rid, ingredient hash) to cuisine, empty if
+        the file is missing.
+    """
+    labels = {}
+    try:
+        labelFile = open(labelsPath, 'rb')
+    except IOError:
+        return labels
+    with labelFile:
+        for line in labelFile:
+            fields = line.rstrip('\r\n').split('<>')
+            if len(fields) < 9: continue
+            ingredients = [ingred.split(';')[0] for ingred in fields[6].split(',')]
+            labels[(int(fields[0]), get_ingredient_hash(ingredients))] = fields[-1]
+    return labels
+
+class CuisineLabels:
+    """
+    Read-only sequence of the cuisine of every row of a RecipeData, used as
+    its |cuisines| column.
+    """
+    def __init__(self, data, cachePath = None, labelsPath = LABELS_PATH, \
+            modelPath = MODEL_PATH, blockSize = BLOCK_SIZE):
+        """
+        @param data: The RecipeData to label.
+        @param cachePath: The persistent cache, or None to keep the labels in
+            memory only.
+        """
+        self.data = data
+        self.cachePath = cachePath
+        self.labelsPath = labelsPath
+        self.modelPath = modelPath
+        self.blockSize = blockSize
+        self.labels = [None] * len(data)
+        self.filled = np.zeros((len(data) + blockSize - 1) // blockSize, dtype=bool)
+        # The sources, loaded on first use.
+        self.cache = None
+        self.fileLabels = None
+        self.model = None
+        self.modelLoaded = False
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, row):
+        if not self.filled[row // self.blockSize]:
+            self.fill_block(row // self.blockSize)
+        return self.labels[row]
+
+    def __iter__(self):
+        for row in xrange(len(self)):
+            yield self[row]
+
+    def get_signature(self):
+        """
+        Returns the signature of the label file and the model, which the
+        cached labels are valid for.
+        """
+        return {'labels': get_file_signature(self.labelsPath), \
+            'model': get_file_signature(os.path.join(self.modelPath, cuisineModel.MANIFEST_NAME))}
+
+    def load_cache(self):
+        """
+        Reads the persistent cache into self.cache, or starts it over if it
+        was written for another label file or model.
+        """
+        self.cache = {}
+        if self.cachePath is None: return
+        signature = self.get_signature()
+        try:
+            with open(self.cachePath, 'rb') as cacheFile:
+                header = cacheFile.readline()
+                if header.startswith('#') and json.loads(header[1:]) == signature:
+                    for line in cacheFile:
+                        fields = line.rstrip('\n').split('\t')
+                        # skip a line cut short by a crash
+                        if len(fields) == 3:
+                            self.cache[(int(fields[0]), fields[1])] = fields[2]
+                    return
+        except (IOError, ValueError):
+            pass
+        # the new header is written under a temporary name and renamed, so a
+        # process still appending to the old cache cannot leave its lines
+        # after the new header
+        tempPath = '%s.%d.tmp' % (self.cachePath, os.getpid())
+        try:
+            with open(tempPath, 'wb') as cacheFile:
+                cacheFile.write('#' + json.dumps(signature) + '\n')
+            os.rename(tempPath, self.cachePath)
+        except (IOError, OSError):
+            self.cachePath = None
+
+    def get_model(self):
+        """
+        Returns the saved CuisineModel, or None if there is none or it cannot
+        be read, in which case a warning is issued.
+        """
+        if not self.modelLoaded:
+            self.modelLoaded = True
+            if os.path.exists(os.path.join(self.modelPath, cuisineModel.MANIFEST_NAME)):
+                try:
+                    self.model = cuisineModel.load_model(self.modelPath)
+                except (IOError, OSError, ValueError) as e:
+                    warnings.warn("Cuisine model %s ignored: %s" % (self.modelPath, e))
+        return self.model
+
+    def fill_block(self, block):
+        """
+        Labels the rows of block |block| from the sources and appends the new
+        labels to the persistent cache.
+        """
+        if self.cache is None: self.load_cache()
+        rows = xrange(block * self.blockSize, min((block + 1) * self.blockSize, len(self)))
+        keys = {}
+        found = []
+        missing = []
+        for row in rows:
+            keys[row] = key = (int(self.data.rids[row]), \
+                get_ingredient_hash(self.data.get_ingredients(row)))
+            if key in self.cache:
+                self.labels[row] = self.cache[key]
+                continue
+            if self.fileLabels is None:
+                self.fileLabels = read_label_file(self.labelsPath)
+            if key in self.fileLabels:
+                self.labels[row] = self.fileLabels[key]
+                found.append(row)
+            else:
+                missing.append(row)
+        if missing and self.get_model() is not None:
+            cuisines = self.model.predict(self.data.get_ingredients(row) for row in missing)
+            for row, cuisine in zip(missing, cuisines):
+                self.labels[row] = cuisine
+                found.append(row)
+        self.filled[block] = True
+        if found and self.cachePath is not None:
+            lines = []
+            for row in found:
+                self.cache[keys[row]] = self.labels[row]
+                lines.append('%d\t%s\t%s\n' % (keys[row][0], keys[row][1], self.labels[row]))
+            try:
+                # one write per block, so that processes sharing the cache
+                # do not interleave their lines
+                with open(self.cachePath, 'ab') as cacheFile:
+                    cacheFile.write(''.join(lines))
+            except IOError:
+                pass
@@ -0,0 +1,169 @@
+import json, os, shutil, time
+import numpy as np
+from scipy import sparse
+
+# Trained cuisine classifier, saved by cuisineClassifier/classifyCuisine.py
+# ('python classifyCuisine.py train') and loaded here with NumPy alone, so
+# that recipes can be labeled without sklearn or retraining:
+#   model = cuisineModel.load_model('../cuisineClassifier/cuisineModel')
+#   model.predict([['flour', 'egg', 'sugar'], ['soy sauce', 'rice']])
+#
+# The model is a directory holding:
+#   - manifest.json: the format version, the ingredient vocabulary (the name
+#     of every feature column, in order), the cuisine label of every class,
+#     the file, dtype and shape of every array and free-form training
+#     information
+#   - coef.npy: the (classes x vocabulary) weights of the one-vs-rest linear
+#     model, with a single row for two classes
+#   - intercept.npy: its intercepts, one per row of coef
+# The arrays are memory-mapped on load. A model of another FORMAT_VERSION is
+# refused.
+
+FORMAT_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+
+def make_ingredient_index(vocabulary):
+    """
+    Returns the dict from each ingredient of the sequence |vocabulary| to its
+    feature column, its position in |vocabulary|.
+    """
+    return dict((ingred, column) for column, ingred in enumerate(vocabulary))
+
+def featurize(ingredientsList, ingredientIndex):
+    """
+    Returns the sparse 0/1 feature matrix of the recipes of |ingredientsList|,
+    an iterable of lists of ingredients, in one pass over their ingredients:
+    row i has a 1 in column ingredientIndex[ingredient] for each ingredient of
+    recipe i. Ingredients missing from |ingredientIndex| are ignored.
+
+    @return X: A scipy.sparse.csr_matrix of one row per recipe and
+        len(ingredientIndex) columns.
+    """
+    indices = []
+    indptr = [0]
+    for ingredients in ingredientsList:
+        # a repeated ingredient sets its column once
+        indices.extend(sorted(set(ingredientIndex[ingred] for ingred in ingredients \
+            if ingred in ingredientIndex)))
+        indptr.append(len(indices))
+    data = np.ones(len(indices), dtype=np.float64)
+    return sparse.csr_matrix((data, np.array(indices, dtype=np.int32), \
+        np.array(indptr, dtype=np.int32)), shape=(len(indptr) - 1, len(ingredientIndex)))
+
+class CuisineModel:
+    def __init__(self, vocabulary, labels, coef, intercept, info = None):
+        """
+        @param vocabulary: The ingredient of every feature column.
+        @param labels: The cuisine of every class, in the order of the classes
+            of the linear model.
+        @param coef, intercept: The weights of the linear model, as in
+            sklearn's LogisticRegression.
+        @param info: A JSON-serializable dict about the training, or None.
+        """
+        self.vocabulary = list(vocabulary)
+        self.ingredientIndex = make_ingredient_index(self.vocabulary)
+        self.labels = list(labels)
+        self.coef = coef
+        self.intercept = intercept
+        self.info = info or {}
+
+    def featurize(self, ingredientsList):
+        """
+        Returns the feature matrix of |ingredientsList| (see featurize()).
+        """
+        return featurize(ingredientsList, self.ingredientIndex)
+
+    def decision_function(self, X):
+        """
+        Returns the score of every class for the rows of the feature matrix
+        |X|, of shape (rows, len(coef)).
+        """
+        return np.asarray(X.dot(self.coef.T)) + self.intercept
+
+    def predict_features(self, X):
+        """
+        Returns the list of the cuisines of the rows of the feature matrix |X|.
+        """
+        scores = self.decision_function(X)
+        if scores.shape[1] == 1:
+            # two classes: a positive score is the second one
+            classes = (scores[:, 0] > 0).astype(int)
+        else:
+            classes = scores.argmax(axis=1)
+        return [self.labels[c] for c in classes]
+
+    def predict(self, ingredientsList):
+        """
+        Returns the list of the cuisines of the recipes of |ingredientsList|,
+        an iterable of lists of ingredients.
+        """
+        return self.predict_features(self.featurize(ingredientsList))
+
+    def save(self, modelPath):
+        """
+        Writes the model to the directory |modelPath|, replacing any model
+        there. It is written under a temporary name and renamed, so readers
+        never see a partial model.
+        """
+        tempPath = '%s.%d.tmp' % (modelPath.rstrip(os.sep), os.getpid())
+        if os.path.exists(tempPath): shutil.rmtree(tempPath)
+        os.makedirs(tempPath)
+        arrays = {}
+        for name, array in [('coef', self.coef), ('intercept', self.intercept)]:
+            array = np.ascontiguousarray(array, dtype=np.float64)
+            np.save(os.path.join(tempPath, name + '.npy'), array)
+            arrays[name] = {'file': name + '.npy', 'dtype': array.dtype.str, \
+                'shape': list(array.shape)}
+        manifest = {'version': FORMAT_VERSION, 'vocabulary': self.vocabulary, \
+            'labels': self.labels, 'arrays': arrays, 'info': self.info}
+        with open(os.path.join(tempPath, MANIFEST_NAME), 'w') as output:
+            json.dump(manifest, output, indent=2, sort_keys=True, separators=(',', ': '))
+        if os.path.exists(modelPath): shutil.rmtree(modelPath)
+        os.rename(tempPath, modelPath)
+
+def from_sklearn(predictor, vocabulary, labelNames, info = None):
+    """
+    Returns the CuisineModel of the trained sklearn linear classifier
+    |predictor|, whose feature columns are the ingredients of |vocabulary| in
+    order.
+
+    @param labelNames: The dict from each class of |predictor| to its cuisine.
+    """
+    info = dict(info or {}, trainedAt=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    return CuisineModel(vocabulary, [labelNames[c] for c in predictor.classes_], \
+        np.array(predictor.coef_, dtype=np.float64), \
+        np.array(predictor.intercept_, dtype=np.float64), info)
+
+def load_model(modelPath, mmap = True):
+    """
+    Returns the CuisineModel saved in the directory |modelPath|, with its
+    arrays memory-mapped unless |mmap| is False.
+
+    @raise ValueError: If the model is of another format version, its
+        manifest is incomplete or its arrays do not match the manifest.
+    """
+    with open(os.path.join(modelPath, MANIFEST_NAME)) as manifestFile:
+        manifest = json.load(manifestFile)
+    if manifest.get('version') != FORMAT_VERSION:
+        raise ValueError("Cuisine model %s has format version %s, expected %d" % \
+            (modelPath, manifest.get('version'), FORMAT_VERSION))
+    try:
+        arrays = {}
+        for name, layout in manifest['arrays'].iteritems():
+            array = np.load(os.path.join(modelPath, layout['file']), \
+                mmap_mode='r' if mmap else None)
+            if array.dtype.str != layout['dtype'] or list(array.shape) != layout['shape']:
+                raise ValueError("Cuisine model %s: %s does not match its manifest" % \
+                    (modelPath, layout['file']))
+            arrays[str(name)] = array
+        vocabulary = [str(ingred) for ingred in manifest['vocabulary']]
+        labels = [str(label) for label in manifest['labels']]
+        numRows = 1 if len(labels) == 2 else len(labels)
+        if arrays['coef'].shape != (numRows, len(vocabulary)) or \
+                arrays['intercept'].shape != (numRows,):
+            raise ValueError("Cuisine model %s: the arrays do not match the vocabulary and labels" % \
+                modelPath)
+    except KeyError as e:
+        raise ValueError("Cuisine model %s: the manifest has no %s" % (modelPath, e))
+    return CuisineModel(vocabulary, labels, arrays['coef'], arrays['intercept'], \
+        manifest.get('info'))
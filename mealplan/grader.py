@@ -51,8 +51,11 @@ profile.setRecipeBook(recipeBook)
 #profile.print_info()
 cspConstructor = csp.MealPlanCSPConstructor(recipeBook, copy.deepcopy(profile))
 mealCSP = cspConstructor.get_basic_csp()
+print "Presolve kept %d of %d (recipe, meal) pairs and %d of %d recipes" % \
+    (len(cspConstructor.variables), cspConstructor.numPairs, \
+    len(cspConstructor.recipeVariables), len(cspConstructor.profile.requests))
 alg = algorithms.BacktrackingSearch()
-alg.solve(mealCSP, True, True)
+alg.solve(mealCSP, True, True, optimize = True)
 # assignment = alg.allAssignments[0]
 # print assignment
 solution = util.extract_meal_plan_solution(profile, alg.optimalAssignment)
@@ -1,130 +1,219 @@
 import random
 import csv, string
-import collections
+import collections, os
+import numpy as np
+import cuisineLabels
+import recipeCache
 
 ############################################################
 # Meal Plan specifics.
 
-# Information about a Recipe:
-# - self.rid: recipe ID 
-# - self.name: name of the recipe
-# - self.cuisine: cuisine of recipe
-# - self.calorieCount: calorie count of recipe
-# - self.rating: average rating for the recipe
-# - self.reviewCount: review counts for the recipe
-# - self.cookingTime: cooking time of recipe
-# - self.servingSize: number of servings
-# - self.ingredients: dictionary of ingredient names to quantity required (infinity for now)
-# - self.shelfLife: shelf life of the ingredients
-# - self.instructions: instructions for making the recipe
-class Recipe:
-	def __init__(self, info):
-		self.__dict__.update(info)
+# A Recipe is a lightweight view of one row of a RecipeBook, which stores the
+# recipe information in columns:
+# - self.book: the RecipeBook holding the recipe
+# - self.index: row of the recipe in the columns of the book
+# - self.rid: recipe ID (an int), which identifies the recipe
+# The getters read the columns of the book: name, cuisine, calorie count,
+# average rating, review count, cooking time, number of servings, dictionary
+# of ingredient names to quantity required, shelf life of the ingredients and
+# instructions for making the recipe.
+class Recipe(object):
+	__slots__ = ('book', 'index', 'rid')
+
+	def __init__(self, book, index):
+		self.book = book
+		self.index = index
+		self.rid = int(book.rids[index])
 
 	def getName(self):
-		return self.name
+		return self.book.names[self.index]
 
 	def getCalorieCount(self):
-		return self.calorieCount
+		return int(self.book.calorieCounts[self.index])
 
 	def getCookingTime(self):
-		return self.cookingTime
+		return int(self.book.cookingTimes[self.index])
 
 	def getServingSize(self):
-		return self.servingSize
+		return self.book.servingSizes[self.index]
 
 	def getIngredients(self):
-		return self.ingredients
+		quantities = self.book.quantities
+		start, end = quantities.indptr[self.index], quantities.indptr[self.index + 1]
+		return collections.OrderedDict((self.book.ingredientNames[col], qty) \
+			for col, qty in zip(quantities.indices[start:end].tolist(), quantities.data[start:end].tolist()))
+
+	def getQuantity(self, ingred):
+		"""
+		Returns the quantity of |ingred| the recipe requires, 0 if none.
+		"""
+		col = self.book.ingredientIndex.get(ingred)
+		if col is None: return 0
+		quantities = self.book.quantities
+		start, end = quantities.indptr[self.index], quantities.indptr[self.index + 1]
+		hits = np.flatnonzero(quantities.indices[start:end] == col)
+		return float(quantities.data[start + hits[0]]) if len(hits) else 0
 
 	def getCuisine(self):
-		return self.cuisine
+		return self.book.cuisines[self.index]
 
 	def getRating(self):
-		return self.rating
+		return float(self.book.ratings[self.index])
 
 	def getReviewCount(self):
-		return self.reviewCount
+		return int(self.book.reviewCounts[self.index])
 
 	def getShelfLife(self):
-		return self.shelfLife
+		return collections.OrderedDict((ingred, self.book.ingredShelfLife[ingred]) \
+			for ingred in self.getIngredients())
 
 	def getInstructions(self):
-		return self.instructions
+		return self.book.instructions[self.index]
 
 	def has_all_ingreds(self, ingredsAvailable):
 		if ingredsAvailable is None:
 			return True
-		return set(self.ingredients.keys()) < set(ingredsAvailable)
+		if not isinstance(ingredsAvailable, (dict, set, frozenset)):
+			ingredsAvailable = set(ingredsAvailable)
+		# the ingredients must be a proper subset of the available ones
+		quantities = self.book.quantities
+		start, end = quantities.indptr[self.index], quantities.indptr[self.index + 1]
+		return end - start < len(ingredsAvailable) and all(self.book.ingredientNames[col] in ingredsAvailable \
+			for col in quantities.indices[start:end].tolist())
 
-	def short_str(self): return '%s: %s' % (self.rid, self.name)
+	def short_str(self): return '%s: %s' % (self.rid, self.getName())
 
 	def __str__(self):
-		return 'Recipe{rid: %s, name: %s, cuisine: %s, calorie count: %s, cooking time: %s, serving size: %s, ingredients: %s}' % (self.rid, self.name, self.cuisine, self.calorieCount, self.cookingTime, self.servingSize, self.ingredients)
+		return 'Recipe{rid: %s, name: %s, cuisine: %s, calorie count: %s, cooking time: %s, serving size: %s, ingredients: %s}' % (self.rid, self.getName(), self.getCuisine(), self.getCalorieCount(), self.getCookingTime(), self.getServingSize(), self.getIngredients())
+
+	def __eq__(self, other): return isinstance(other, Recipe) and self.rid == other.rid
 
-	def __eq__(self, other): return str(self) == str(other)
+	def __ne__(self, other): return not self == other
 
-	def __cmp__(self, other): return cmp(str(self), str(other))
+	def __cmp__(self, other): return cmp(self.rid, other.rid)
 
-	def __hash__(self): return hash(str(self))
+	def __hash__(self): return hash(self.rid)
 
 	def __repr__(self): return str(self)
 
 
-# Information about all the Recipes
-class RecipeBook:
-	def __init__(self, recipesPath, profile):
+# The RecipeData of each recipe file loaded by load_recipe_data(), keyed by
+# (path, useCache), with the mtime and size of the file when it was loaded.
+loadedRecipeData = {}
+
+def load_recipe_data(recipesPath, useCache = True):
+	"""
+	Returns the profile-independent RecipeData of the file |recipesPath| (see
+	recipeCache). It is loaded once per process and shared by every RecipeBook
+	built from the same file, until the file changes. Its cuisines are
+	labeled on first use (see cuisineLabels), with the labels kept in
+	|recipesPath| + '.cuisines' if |useCache|.
+	"""
+	key = (os.path.abspath(recipesPath), useCache)
+	stat = os.stat(recipesPath)
+	if key not in loadedRecipeData or loadedRecipeData[key][0] != (stat.st_mtime, stat.st_size):
+		data = recipeCache.load_recipes(recipesPath, useCache = useCache)
+		data.cuisines = cuisineLabels.CuisineLabels(data, \
+			recipesPath + '.cuisines' if useCache else None)
+		loadedRecipeData[key] = ((stat.st_mtime, stat.st_size), data)
+	return loadedRecipeData[key][1]
+
+# The Recipes a profile can cook. The recipe information is stored in the
+# columns of a shared RecipeData, with one row per recipe of the recipe file,
+# and exposed here without copies:
+# - self.rids, self.cookingTimes, self.calorieCounts, self.ratings,
+#   self.reviewCounts: NumPy arrays
+# - self.names, self.instructions: sequences of strings
+# - self.cuisines: sequence of cuisines, labeled on first use when the book
+#   comes from load_recipe_data() (see cuisineLabels)
+# - self.servingSizes: list
+# - self.quantities: CSR sparse matrix of recipe x ingredient quantities, where
+#   column j is the ingredient self.ingredientNames[j] and each row keeps the
+#   order of the ingredients in the recipe
+# - self.shelfLives: NumPy array of the shortest shelf life, for the profile,
+#   of the ingredients of each cookable recipe (inf for the other rows)
+# self.cookable holds the rows of the recipes the profile can cook, and
+# self.recipes maps their rids to their Recipe views, in the order of the file.
+# Building the book only runs the eligibility query; self.recipes and
+# self.shelfLives are computed on first use.
+class RecipeBook(object):
+	def __init__(self, recipesPath, profile, useCache = True):
 		"""
 		Initialize the recipe book.
 
-		@param recipesPath: Path of a file containing all the recipe information.
+		@param recipesPath: Path of a file containing all the recipe information,
+			or the RecipeData already loaded from it.
+		@param useCache: If True, the recipes are memory-mapped from the binary
+			cache of the file, which is built on first use (see recipeCache).
 		"""
-		# Read recipes (CSV format)
-		self.recipes = {}
-		with open(recipesPath, 'rb') as dataset:
-			for line in dataset:
-				ingredients = collections.OrderedDict()
-				shelfLife = collections.OrderedDict()
-				line = line.split("<>")
-				ingredString = line[6]
-				ingredList = ingredString.split(',')
-				for ingred in ingredList:
-					ingred = ingred.split(';')
-					slashPos = ingred[1].find('/')
-					intPart = 0
-					floatPart = 0.0
-					try:
-						if slashPos >= 0:
-							splits = ingred[1][:slashPos].split()
-							if len(splits)>1:
-								intPart = int(splits[0])
-							floatPart = (float(splits[-1])/float(ingred[1][slashPos+1:]))
-						else:
-							intPart = int(ingred[1])
-					except ValueError:
-						intPart = 0
-					ingredients[ingred[0]] = intPart + floatPart
-#                if set(ingredients.keys()).issubset(set(profile.availableIngreds.keys())):
-				flag = True
-				for ingred in ingredients:
-					if ingred not in profile.availableIngreds or ingredients[ingred]>profile.availableIngreds[ingred]:
-						flag = False
-					else:
-						shelfLife[ingred] = profile.ingredShelfLife[ingred]
-
-				if flag:
-					recipeInfo = {}
-					recipeInfo["rid"] = line[0]
-					recipeInfo["name"] = line[1]
-					recipeInfo["cookingTime"] = int(line[2])
-					recipeInfo["calorieCount"] = int(line[3])
-					recipeInfo["rating"] = float(line[4])
-					recipeInfo["reviewCount"] = int(line[5])
-					recipeInfo["instructions"] = line[7].lower()
-					recipeInfo["cuisine"] = None
-					recipeInfo["servingSize"] = None
-					recipeInfo["ingredients"] = ingredients
-					recipeInfo["shelfLife"] = shelfLife
-					self.recipes[line[0]] = Recipe(recipeInfo)
+		if isinstance(recipesPath, recipeCache.RecipeData):
+			data = recipesPath
+		else:
+			data = load_recipe_data(recipesPath, useCache)
+		self.data = data
+		self.rids = data.rids
+		self.cookingTimes = data.cookingTimes
+		self.calorieCounts = data.calorieCounts
+		self.ratings = data.ratings
+		self.reviewCounts = data.reviewCounts
+		self.names = data.names
+		self.instructions = data.instructions
+		self.cuisines = data.cuisines
+		self.servingSizes = data.servingSizes
+		self.ingredientNames = data.ingredientNames
+		self.ingredientIndex = data.ingredientIndex
+		self.quantities = data.quantities
+
+		# Only the recipes whose ingredients are all available in large enough
+		# quantities can be cooked.
+		self.cookable = data.find_cookable(profile.availableIngreds)
+		self.ingredShelfLife = dict(profile.ingredShelfLife)
+		self.recipeViews = None
+		self.shelfLifeColumn = None
+
+	@property
+	def recipes(self):
+		if self.recipeViews is None:
+			self.recipeViews = collections.OrderedDict((rid, Recipe(self, index)) \
+				for rid, index in zip(self.rids[self.cookable].tolist(), self.cookable.tolist()))
+		return self.recipeViews
+
+	@property
+	def shelfLives(self):
+		if self.shelfLifeColumn is None:
+			self.shelfLifeColumn = np.full(len(self.rids), np.inf)
+			self.shelfLifeColumn[self.cookable] = self.get_shelf_lives(self.cookable)
+		return self.shelfLifeColumn
+
+	def get_shelf_lives(self, rows):
+		"""
+		Returns the shortest shelf life of the ingredients of each recipe in
+		|rows|, inf for a recipe without ingredients of limited shelf life.
+		"""
+		shelfLives = np.full(len(self.ingredientNames), np.inf)
+		for ingred, shelfLife in self.ingredShelfLife.iteritems():
+			if ingred in self.ingredientIndex:
+				shelfLives[self.ingredientIndex[ingred]] = shelfLife
+		starts = self.quantities.indptr[rows]
+		lengths = self.quantities.indptr[rows + 1] - starts
+		result = np.full(len(rows), np.inf)
+		nonEmpty = lengths > 0
+		if nonEmpty.any():
+			# positions in self.quantities of the ingredients of the rows, row by row
+			segments = np.cumsum(lengths) - lengths
+			positions = np.arange(lengths.sum()) + np.repeat(starts - segments, lengths)
+			result[nonEmpty] = np.minimum.reduceat(shelfLives[self.quantities.indices[positions]], \
+				segments[nonEmpty])
+		return result
+
+	def within_quantities(self, availableIngreds):
+		"""
+		Returns a boolean array over the rows of the book, True for the recipes
+		that need no more of any ingredient than |availableIngreds| (a dict from
+		ingredient to quantity, or None for no limits) holds. Ingredients missing
+		from |availableIngreds| are not limited.
+		"""
+		return self.data.within_quantities(availableIngreds)
 
 # Given the path to a preference file and a
 class Profile:
@@ -0,0 +1,408 @@
+import collections, hashlib, json, mmap, os, struct
+import numpy as np
+from scipy import sparse
+
+# Binary cache of a recipe file in the '<>' separated format of recipeData.txt:
+#   rid<>name<>cooking time<>calories<>rating<>review count<>ingredients<>instructions
+# where ingredients is a ',' separated list of 'ingredient;quantity'.
+#
+# The file is parsed once by compile_recipes() and later runs memory-map the
+# cache with load_recipes(), so startup does not depend on the number of
+# recipes and the pages are shared by all the processes reading it. Layout:
+#   MAGIC (8 bytes), header length (little-endian uint64), JSON header,
+#   then every array at an offset aligned on ALIGNMENT bytes.
+# The header holds the format version, the mtime, size and SHA-1 of the
+# source file, and the dtype, shape and offset of every array:
+#   - rids, cookingTimes, calorieCounts, ratings, reviewCounts: one row per
+#     recipe, in the order of the source file
+#   - quantityData, quantityIndices, quantityIndptr: the CSR recipe x
+#     ingredient quantity matrix, each row in the order of the recipe
+#   - ingredientData, ingredientRows, ingredientIndptr: the same matrix in
+#     CSC form, i.e. the inverted index from each ingredient to the recipes
+#     using it
+#   - nameHeap/nameOffsets, instructionHeap/instructionOffsets and
+#     ingredientHeap/ingredientOffsets: string heaps, where string i is
+#     heap[offsets[i]:offsets[i+1]]; instructions are stored lowercased and
+#     ingredient i is the name of column i of the quantity matrix
+# A cache written by another FORMAT_VERSION or for another source file is
+# rebuilt.
+
+MAGIC = 'RCPCACHE'
+FORMAT_VERSION = 2
+ALIGNMENT = 64
+
+class StringHeap:
+    """
+    Read-only sequence of the strings stored in a string heap.
+    """
+    def __init__(self, heap, offsets):
+        self.heap = heap
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.heap[self.offsets[index]:self.offsets[index + 1]].tostring()
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+# The columns of a recipe file, as described at the top of this module:
+# - self.rids, self.cookingTimes, self.calorieCounts, self.ratings,
+#   self.reviewCounts: NumPy arrays
+# - self.names, self.instructions: StringHeaps
+# - self.ingredientNames: list of the ingredient names, and
+#   self.ingredientIndex the dict from ingredient name to column
+# - self.quantities: CSR sparse matrix of recipe x ingredient quantities, and
+#   self.recipesByIngredient the same matrix in CSC form
+# - self.cuisines, self.servingSizes: lists, None where unknown
+# It does not depend on any profile: a single RecipeData can be shared by the
+# RecipeBooks of any number of profiles, which query it through the inverted
+# index: find_cookable(), get_missing_counts(), get_recipes_using() and
+# within_quantities().
+class RecipeData:
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.rids = arrays['rids']
+        self.cookingTimes = arrays['cookingTimes']
+        self.calorieCounts = arrays['calorieCounts']
+        self.ratings = arrays['ratings']
+        self.reviewCounts = arrays['reviewCounts']
+        self.names = StringHeap(arrays['nameHeap'], arrays['nameOffsets'])
+        self.instructions = StringHeap(arrays['instructionHeap'], arrays['instructionOffsets'])
+        self.ingredientNames = list(StringHeap(arrays['ingredientHeap'], \
+            arrays['ingredientOffsets']))
+        self.ingredientIndex = {ingred: col for col, ingred in enumerate(self.ingredientNames)}
+        self.quantities = sparse.csr_matrix((arrays['quantityData'], arrays['quantityIndices'], \
+            arrays['quantityIndptr']), shape=(len(self.rids), len(self.ingredientNames)))
+        self.recipesByIngredient = sparse.csc_matrix((arrays['ingredientData'], \
+            arrays['ingredientRows'], arrays['ingredientIndptr']), shape=self.quantities.shape)
+        # number of distinct ingredients of each recipe, and the rows sorted by
+        # that number
+        self.ingredientCounts = np.diff(self.quantities.indptr)
+        self.rowsByIngredientCount = np.argsort(self.ingredientCounts, kind='mergesort')
+        self.sortedIngredientCounts = self.ingredientCounts[self.rowsByIngredientCount]
+        self.cuisines = [None] * len(self.rids)
+        self.servingSizes = [None] * len(self.rids)
+
+    def __len__(self):
+        return len(self.rids)
+
+    def get_ingredients(self, index):
+        """
+        Returns the names of the ingredients of the recipe at row |index|, in
+        the order of the recipe.
+        """
+        start, end = self.quantities.indptr[index], self.quantities.indptr[index + 1]
+        return [self.ingredientNames[col] for col in self.quantities.indices[start:end]]
+
+    def get_postings(self, ingred):
+        """
+        Returns the (rows, quantities) arrays of the recipes using |ingred|,
+        empty if no recipe does.
+        """
+        col = self.ingredientIndex.get(ingred)
+        if col is None: return self.recipesByIngredient.indices[:0], self.recipesByIngredient.data[:0]
+        start, end = self.recipesByIngredient.indptr[col], self.recipesByIngredient.indptr[col + 1]
+        return self.recipesByIngredient.indices[start:end], self.recipesByIngredient.data[start:end]
+
+    def get_recipes_using(self, ingred):
+        """
+        Returns the rows of the recipes using |ingred|, in increasing order.
+        """
+        return self.get_postings(ingred)[0]
+
+    def get_found_counts(self, availableIngreds):
+        """
+        Returns the (rows, counts) arrays of the recipes using at least one of
+        the |availableIngreds| (a dict from ingredient to quantity) in a small
+        enough quantity, with the number of such ingredients of each. Only the
+        postings of the available ingredients are visited.
+        """
+        hits = []
+        for ingred, quantity in availableIngreds.iteritems():
+            rows, quantities = self.get_postings(ingred)
+            hits.append(rows[quantities <= quantity])
+        if not hits:
+            return self.rids[:0].astype(np.int64), self.ingredientCounts[:0]
+        return np.unique(np.concatenate(hits), return_counts=True)
+
+    def get_missing_counts(self, availableIngreds):
+        """
+        Returns the array over all the rows of the number of ingredients of each
+        recipe that are missing from |availableIngreds| (a dict from ingredient
+        to quantity) or not available in a large enough quantity.
+        """
+        missing = self.ingredientCounts.copy()
+        rows, counts = self.get_found_counts(availableIngreds)
+        missing[rows] -= counts.astype(missing.dtype)
+        return missing
+
+    def find_cookable(self, availableIngreds, maxMissing = 0):
+        """
+        Returns the rows, in increasing order, of the recipes with at most
+        |maxMissing| ingredients missing from |availableIngreds| (a dict from
+        ingredient to quantity, or None for no limits) or not available in a
+        large enough quantity; with the default 0, the recipes that can be
+        cooked.
+
+        The time depends on the postings of the available ingredients and on
+        the number of recipes found, not on the size of the book: the recipes
+        with a missing ingredient count of at most |maxMissing| either use an
+        available ingredient or have at most |maxMissing| ingredients at all.
+        """
+        if availableIngreds is None:
+            return np.arange(len(self.rids))
+        rows, counts = self.get_found_counts(availableIngreds)
+        rows = rows[self.ingredientCounts[rows] - counts <= maxMissing]
+        small = self.rowsByIngredientCount[:np.searchsorted(self.sortedIngredientCounts, \
+            maxMissing, side='right')]
+        if len(small) == 0: return rows
+        return np.union1d(rows, small)
+
+    def get_cookable(self, availableIngreds):
+        """
+        Returns a boolean array over the rows, True for the recipes whose
+        ingredients are all in |availableIngreds| (a dict from ingredient to
+        quantity, or None for no limits) in large enough quantities.
+        """
+        cookable = np.zeros(len(self.rids), dtype=bool)
+        cookable[self.find_cookable(availableIngreds)] = True
+        return cookable
+
+    def within_quantities(self, availableIngreds):
+        """
+        Returns a boolean array over the rows, True for the recipes that need no
+        more of any ingredient than |availableIngreds| (a dict from ingredient
+        to quantity, or None for no limits) holds. Unlike get_cookable(), the
+        ingredients missing from |availableIngreds| are not limited.
+        """
+        within = np.ones(len(self.rids), dtype=bool)
+        for ingred, quantity in (availableIngreds or {}).iteritems():
+            rows, quantities = self.get_postings(ingred)
+            within[rows[quantities > quantity]] = False
+        return within
+
+def parse_quantity(quantity):
+    """
+    Returns the number written in |quantity|, such as '2', '1/4' or '1 1/2',
+    or 0 if it cannot be read.
+    """
+    slashPos = quantity.find('/')
+    intPart = 0
+    floatPart = 0.0
+    try:
+        if slashPos >= 0:
+            splits = quantity[:slashPos].split()
+            if len(splits)>1:
+                intPart = int(splits[0])
+            floatPart = (float(splits[-1])/float(quantity[slashPos+1:]))
+        else:
+            intPart = int(quantity)
+    except ValueError:
+        intPart = 0
+    return intPart + floatPart
+
+def make_string_heap(strings):
+    """
+    Returns the (heap, offsets) arrays storing |strings|.
+    """
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(string) for string in strings])
+    heap = np.frombuffer(''.join(strings), dtype=np.uint8) if strings else \
+        np.zeros(0, dtype=np.uint8)
+    return heap, offsets
+
+def parse_recipes(recipesPath):
+    """
+    Parses the recipe file |recipesPath|.
+
+    @return arrays: The dict of the arrays described at the top of this module.
+    """
+    columns = collections.defaultdict(list)
+    ingredientNames = []
+    ingredientIndex = {}
+    indices = []
+    data = []
+    indptr = [0]
+    with open(recipesPath, 'rb') as dataset:
+        for line in dataset:
+            line = line.split("<>")
+            # a repeated ingredient keeps its first position and its last quantity
+            ingredients = collections.OrderedDict()
+            for ingred in line[6].split(','):
+                ingred = ingred.split(';')
+                ingredients[ingred[0]] = parse_quantity(ingred[1])
+            columns['rids'].append(int(line[0]))
+            columns['names'].append(line[1])
+            columns['cookingTimes'].append(int(line[2]))
+            columns['calorieCounts'].append(int(line[3]))
+            columns['ratings'].append(float(line[4]))
+            columns['reviewCounts'].append(int(line[5]))
+            columns['instructions'].append(line[7].lower())
+            for ingred, qty in ingredients.iteritems():
+                if ingred not in ingredientIndex:
+                    ingredientIndex[ingred] = len(ingredientNames)
+                    ingredientNames.append(ingred)
+                indices.append(ingredientIndex[ingred])
+                data.append(qty)
+            indptr.append(len(indices))
+
+    arrays = {
+        'rids': np.array(columns['rids'], dtype=np.int64),
+        'cookingTimes': np.array(columns['cookingTimes'], dtype=np.int64),
+        'calorieCounts': np.array(columns['calorieCounts'], dtype=np.int64),
+        'ratings': np.array(columns['ratings'], dtype=np.float64),
+        'reviewCounts': np.array(columns['reviewCounts'], dtype=np.int64),
+        'quantityData': np.array(data, dtype=np.float64),
+        'quantityIndices': np.array(indices, dtype=np.int32),
+        'quantityIndptr': np.array(indptr, dtype=np.int32 if len(data) < 2**31 else np.int64),
+    }
+    byIngredient = sparse.csr_matrix((arrays['quantityData'], arrays['quantityIndices'], \
+        arrays['quantityIndptr']), shape=(len(indptr) - 1, len(ingredientNames))).tocsc()
+    arrays['ingredientData'] = byIngredient.data
+    arrays['ingredientRows'] = byIngredient.indices
+    arrays['ingredientIndptr'] = byIngredient.indptr
+    arrays['nameHeap'], arrays['nameOffsets'] = make_string_heap(columns['names'])
+    arrays['instructionHeap'], arrays['instructionOffsets'] = \
+        make_string_heap(columns['instructions'])
+    arrays['ingredientHeap'], arrays['ingredientOffsets'] = make_string_heap(ingredientNames)
+    return arrays
+
+def get_source_signature(recipesPath, withHash = True):
+    """
+    Returns the mtime, size and (if |withHash|) SHA-1 of the file |recipesPath|.
+    """
+    stat = os.stat(recipesPath)
+    signature = {'mtime': stat.st_mtime, 'size': stat.st_size}
+    if withHash:
+        sha1 = hashlib.sha1()
+        with open(recipesPath, 'rb') as source:
+            for block in iter(lambda: source.read(1 << 20), ''):
+                sha1.update(block)
+        signature['sha1'] = sha1.hexdigest()
+    return signature
+
+def write_cache(cachePath, arrays, signature):
+    """
+    Writes |arrays| to |cachePath| in the binary format, for the source file
+    of |signature|. The file is written under a temporary name and renamed,
+    so readers never see a partial cache.
+    """
+    layout = {}
+    offset = 0
+    for name in sorted(arrays):
+        offset = (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        layout[name] = [arrays[name].dtype.str, list(arrays[name].shape), offset]
+        offset += arrays[name].nbytes
+    header = json.dumps({'version': FORMAT_VERSION, 'source': signature, 'arrays': layout})
+    # array offsets are relative to the aligned end of the header
+    start = (len(MAGIC) + 8 + len(header) + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+    tempPath = '%s.%d.tmp' % (cachePath, os.getpid())
+    with open(tempPath, 'wb') as cache:
+        cache.write(MAGIC)
+        cache.write(struct.pack('<Q', len(header)))
+        cache.write(header)
+        for name in sorted(arrays):
+            cache.seek(start + layout[name][2])
+            cache.write(np.ascontiguousarray(arrays[name]).tostring())
+        # so that empty arrays at the end are still inside the file
+        cache.truncate(start + offset)
+    os.rename(tempPath, cachePath)
+
+def read_cache(cachePath, recipesPath):
+    """
+    Memory-maps the cache |cachePath| of the recipe file |recipesPath|.
+
+    @return arrays: The dict of the arrays of the cache, which are read-only
+        views of the mapped file, or None if the cache is missing, of another
+        format version, truncated or stale. The cache is stale when the mtime or size of
+        the source changed, unless its SHA-1 is still the same, in which case
+        the cache is rewritten with the new mtime.
+    """
+    try:
+        cache = open(cachePath, 'rb')
+    except IOError:
+        return None
+    with cache:
+        if cache.read(len(MAGIC)) != MAGIC: return None
+        try:
+            headerLength, = struct.unpack('<Q', cache.read(8))
+            header = json.loads(cache.read(headerLength))
+        except (struct.error, ValueError):
+            return None
+        if header['version'] != FORMAT_VERSION: return None
+        source = header['source']
+        signature = get_source_signature(recipesPath, withHash = False)
+        touched = (signature['mtime'], signature['size']) != (source['mtime'], source['size'])
+        if touched:
+            if signature['size'] != source['size'] or \
+                    get_source_signature(recipesPath)['sha1'] != source['sha1']:
+                return None
+        mapped = mmap.mmap(cache.fileno(), 0, access=mmap.ACCESS_READ)
+    start = (len(MAGIC) + 8 + headerLength + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+    arrays = {}
+    for name, (dtype, shape, offset) in header['arrays'].iteritems():
+        dtype = np.dtype(str(dtype))
+        count = int(np.prod(shape))
+        # a truncated cache is stale too
+        if start + offset + count * dtype.itemsize > len(mapped): return None
+        try:
+            arrays[str(name)] = np.frombuffer(mapped, dtype=dtype, count=count, \
+                offset=start + offset).reshape(shape)
+        except ValueError:
+            return None
+    if touched:
+        # only the mtime of the source changed: record it, so that the next
+        # loads do not hash the source again
+        try:
+            write_cache(cachePath, arrays, dict(signature, sha1 = source['sha1']))
+        except (IOError, OSError):
+            pass
+    return arrays
+
+def compile_recipes(recipesPath, cachePath = None):
+    """
+    Parses the recipe file |recipesPath| and writes its binary cache to
+    |cachePath| (by default |recipesPath| + '.cache').
+
+    @return arrays: The parsed arrays.
+    """
+    if cachePath is None: cachePath = recipesPath + '.cache'
+    signature = get_source_signature(recipesPath)
+    arrays = parse_recipes(recipesPath)
+    write_cache(cachePath, arrays, signature)
+    return arrays
+
+def load_recipes(recipesPath, cachePath = None, useCache = True):
+    """
+    Returns the RecipeData of the recipe file |recipesPath|, memory-mapped
+    from its cache at |cachePath| (by default |recipesPath| + '.cache'). A
+    missing or stale cache is compiled first; if it cannot be written or read
+    back the file is parsed in memory.
+
+    @param useCache: If False, always parse the file in memory.
+    """
+    if not useCache:
+        return RecipeData(parse_recipes(recipesPath))
+    if cachePath is None: cachePath = recipesPath + '.cache'
+    arrays = read_cache(cachePath, recipesPath)
+    if arrays is None:
+        try:
+            compile_recipes(recipesPath, cachePath)
+        except (IOError, OSError):
+            return RecipeData(parse_recipes(recipesPath))
+        arrays = read_cache(cachePath, recipesPath)
+        if arrays is None:
+            # the new cache is stale already, e.g. the source changed meanwhile
+            return RecipeData(parse_recipes(recipesPath))
+    return RecipeData(arrays)
+
+if __name__ == '__main__':
+    import sys
+    # python recipeCache.py recipeData.txt [cache path]: (re)build the cache
+    data = compile_recipes(*sys.argv[1:3])
+    print "Compiled %d recipes and %d ingredients" % (len(data['rids']), \
+        len(data['ingredientOffsets']) - 1)
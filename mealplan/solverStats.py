@@ -0,0 +1,111 @@
+import collections, contextlib, json, sys, time
+
+# Size in bytes of one (var, index, val) entry of the undo trail of
+# BacktrackingSearch, not counting the objects it refers to.
+TRAIL_ENTRY_BYTES = sys.getsizeof((None, None, None))
+
+# Instrumentation of a meal plan solve, filled in when passed as |stats| to
+# MealPlanCSPConstructor.get_basic_csp() and BacktrackingSearch.solve() or
+# iter_solutions(). Without it they do no extra work beyond one None test per
+# node, so it costs nothing when disabled.
+#
+# Recorded:
+# - self.phases: wall time of every phase, in seconds: 'construct' and each
+#   of its steps ('construct.add_variables', ...), and 'solve'
+# - self.nodes, self.maxDepth: nodes visited by the search and deepest
+#   number of assigned variables reached
+# - self.backtracksPerDepth: self.backtracksPerDepth[d] is the number of
+#   times the variable assigned at depth d (0 for the first) was unassigned
+# - self.ac3Calls, self.ac3Revisions, self.ac3Prunes: AC-3 runs, arcs revised
+#   and values they pruned
+# - self.propagationPrunes: values pruned by the global constraints
+# - self.domainStoreBytes, self.peakTrail: size of the domains at the root
+#   and largest number of entries on the undo trail
+# The progress callback, if any, is called with to_json() every
+# |progressInterval| seconds of search (checked every 256 nodes).
+class SolverStats:
+    def __init__(self, progress = None, progressInterval = 1.0):
+        self.phases = collections.OrderedDict()
+        self.progress = progress
+        self.progressInterval = progressInterval
+        self.nodes = 0
+        self.maxDepth = 0
+        self.backtracksPerDepth = []
+        self.ac3Calls = 0
+        self.ac3Revisions = 0
+        self.ac3Prunes = 0
+        self.propagationPrunes = 0
+        self.domainStoreBytes = 0
+        self.peakTrail = 0
+        self.searchStart = None
+        self.lastProgress = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context manager adding the wall time of its block to phase |name|.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.time() - start
+
+    def start_search(self, domains):
+        """
+        Called by the search once its |domains| (a dict or a list of value
+        lists) are set up at the root.
+        """
+        self.searchStart = self.lastProgress = time.time()
+        if isinstance(domains, dict):
+            domains = domains.values()
+        self.domainStoreBytes = sys.getsizeof(domains) + sum(sys.getsizeof(domain) \
+            for domain in domains)
+
+    def visit(self, depth, trailLength):
+        """
+        Called by the search at every node, with |depth| variables assigned and
+        |trailLength| entries on the undo trail.
+        """
+        self.nodes += 1
+        if depth > self.maxDepth: self.maxDepth = depth
+        if trailLength > self.peakTrail: self.peakTrail = trailLength
+        if self.progress is not None and self.nodes % 256 == 0:
+            now = time.time()
+            if now - self.lastProgress >= self.progressInterval:
+                self.lastProgress = now
+                self.progress(self.to_json())
+
+    def backtrack(self, depth):
+        """
+        Called by the search when the variable assigned at |depth| is
+        unassigned.
+        """
+        while len(self.backtracksPerDepth) <= depth:
+            self.backtracksPerDepth.append(0)
+        self.backtracksPerDepth[depth] += 1
+
+    def to_json(self):
+        """
+        Returns the statistics as a dictionary of JSON-serializable values.
+        """
+        searchSeconds = time.time() - self.searchStart if self.searchStart else 0.0
+        if 'solve' in self.phases: searchSeconds = self.phases['solve']
+        return {'phases': dict(self.phases),
+            'nodes': self.nodes,
+            'nodesPerSecond': self.nodes / searchSeconds if searchSeconds > 0 else 0.0,
+            'maxDepth': self.maxDepth,
+            'backtracksPerDepth': list(self.backtracksPerDepth),
+            'ac3': {'calls': self.ac3Calls, 'revisions': self.ac3Revisions,
+                'prunes': self.ac3Prunes},
+            'propagationPrunes': self.propagationPrunes,
+            'peakTrailEntries': self.peakTrail,
+            # the trail entries are on top of the domains themselves
+            'peakDomainStoreBytes': self.domainStoreBytes + self.peakTrail * TRAIL_ENTRY_BYTES}
+
+    def dump(self, path):
+        """
+        Writes to_json() to the file |path|.
+        """
+        with open(path, 'w') as output:
+            json.dump(self.to_json(), output, indent = 2, sort_keys = True)
@@ -1,4 +1,5 @@
-import json, re
+import json, math, re
+import numpy as np
 import plannerReqs
 import csp
 import algorithms
@@ -89,16 +90,18 @@ def get_sum_variable(csp, name, variables, maxSum):
         ('sum', |name|, |var|) to avoid conflicts with other variable names.
     @param variables: A list of variables that are already in the CSP that
         have non-negative integer values as its domain.
-    @param maxSum: An integer indicating the maximum sum value allowed. You
-        can use it to get the auxiliary variables' domain
+    @param maxSum: A number indicating the maximum sum value allowed. You
+        can use it to get the auxiliary variables' domain. It must be finite,
+        but need not be an integer, and neither need the values of
+        |variables|: the result is then the sum rounded down.
 
     @return result: The name of a newly created variable with domain range
-        [0, maxSum] such that it's consistent with an assignment of |n|
+        [0, floor(maxSum)] such that it's consistent with an assignment of |n|
         iff the assignment of |variables| sums to |n|.
     """
     # BEGIN_YOUR_CODE (around 20 lines of code expected)
     result = ('sum', name, 'aggregated')
-    csp.add_variable(result, range(maxSum+1))
+    csp.add_variable(result, range(int(math.floor(maxSum)) + 1))
 
     if len(variables) == 0:
         csp.add_unary_factor(result, lambda val: not val)
@@ -114,13 +117,21 @@ def get_sum_variable(csp, name, variables, maxSum):
         A_i = ('sum', name, i)
         csp.add_variable(A_i, curr_domain)
         prev_domain = curr_domain
+        # The factor tables over the pair domains are the largest ones: build
+        # them from the arrays of the pair components instead of calling a
+        # lambda for every combination.
+        before = np.array([b[0] for b in curr_domain])
+        after = np.array([b[1] for b in curr_domain])
         if i == 0:
-            csp.add_unary_factor(A_i, lambda b: b[0] == 0)
+            csp.add_unary_factor(A_i, before == 0)
         else:
-            csp.add_binary_factor(('sum', name, i-1), A_i, lambda a,b: a[1] == b[0])
-        csp.add_binary_factor(X_i, A_i, lambda a,b: b[1] == b[0] + a)
+            csp.add_binary_factor(('sum', name, i-1), A_i, \
+                np.equal.outer([a[1] for a in csp.values[('sum', name, i-1)]], before))
+        csp.add_binary_factor(X_i, A_i, after[np.newaxis, :] == before[np.newaxis, :] + \
+            np.array(domain_i)[:, np.newaxis])
 
-    csp.add_binary_factor(A_i, result, lambda a, b: a[1] == b)
+    csp.add_binary_factor(A_i, result, \
+        np.equal.outer(np.floor([a[1] for a in csp.values[A_i]]), csp.values[result]))
     return result
     # def checkPrev(prevVal, curVal):
     #     if(prevVal[1] == curVal[0]):
@@ -168,7 +179,8 @@ def extract_meal_plan_solution(profile, assign):
    if not assign: return result
    for meal in profile.meals:
        for req in profile.requests:
-            isCooked = assign[(req, meal)]
+            # pairs dropped by the presolve are not variables of the CSP
+            isCooked = assign.get((req, meal), False)
             if isCooked:
                 result.append((req, meal))
    return result